@@ -65,8 +65,15 @@ from falcon import Request, Response, App, HTTPInternalServerError
 import management
 import setup
 import log
+import timing
+import metrics
+import profiler
+import capture
+import recorder
+from imaging import calibration, allsky
 from config import Config
 from discovery import DiscoveryResponder
+import shr
 from shr import set_shr_logger
 
 #########################
@@ -150,10 +157,13 @@ def init_routes(app: App, devname: str, module):
     """
 
     memlist = inspect.getmembers(module, inspect.isclass)
+    routes = 0
     for cname,ctype in memlist:
         if ctype.__module__ == module.__name__:    # Only classes *defined* in the module
             log.logger.info("module " + ctype.__name__)
             app.add_route(f'/api/v{API_VERSION}/{devname}/{{devnum:int(min=0)}}/{cname.lower()}', ctype())  # type() creates instance!
+            routes += 1
+    metrics.gauge('alpaca_routes_registered', 'Alpaca endpoints routed by init_routes()', (('device', devname),)).set(routes)
 
 
 def custom_excepthook(exc_type, exc_value, exc_traceback):
@@ -211,8 +221,12 @@ def falcon_uncaught_exception_handler(req: Request, resp: Response, ex: BaseExce
 # ===========
 # APP STARTUP
 # ===========
-def main():
-    """ Application startup"""
+def create_app() -> App:
+    """Set up logging and the camera, and build the Falcon app with all its routes
+
+    Split from :py:func:`main` so that benchmarks can serve the real app
+    in-process, without discovery and on a port of their choosing.
+    """
 
     logger = log.init_logging()
     # Share this logger throughout
@@ -220,7 +234,16 @@ def main():
     exceptions.logger = logger
     camera.start_camera_device(logger)
     discovery.logger = logger
+    timing.logger = logger
+    profiler.logger = logger
+    capture.logger = logger
+    recorder.logger = logger
+    calibration.logger = logger
+    allsky.logger = logger
     set_shr_logger(logger)
+    if Config.record_traffic:
+        shr.traffic = shr.TrafficRecorder(Config.record_file)
+        logger.info(f'Recording Alpaca requests to {Config.record_file}')
 
     #########################
     # FOR EACH ASCOM DEVICE #
@@ -232,16 +255,11 @@ def main():
     # -----------------------------
     sys.excepthook = custom_excepthook
 
-    # ---------
-    # DISCOVERY
-    # ---------
-    _DSC = DiscoveryResponder(Config.ip_address, Config.port)
-
     # ----------------------------------
     # MAIN HTTP/REST API ENGINE (FALCON)
     # ----------------------------------
     # falcon.App instances are callable WSGI apps
-    falc_app = App()
+    falc_app = App(middleware=[metrics.MetricsMiddleware(), profiler.ProfilerMiddleware()])
     #
     # Initialize routes for each endpoint the magic way
     #
@@ -256,18 +274,35 @@ def main():
     falc_app.add_route(f'/management/v{API_VERSION}/configureddevices', management.configureddevices())
     falc_app.add_route('/setup', setup.svrsetup())
     falc_app.add_route(f'/setup/v{API_VERSION}/camera/{{devnum}}/setup', setup.devsetup())
+    falc_app.add_route('/metrics', metrics.metrics())
+    falc_app.add_route('/timing', timing.timings())
+    falc_app.add_route('/profile', profiler.profile())
+    metrics.gauge('alpaca_log_records_dropped', 'Log records dropped because the log queue was full', fn=log.dropped)
+    metrics.gauge('alpaca_sensor_temperature_celsius', 'Sensor temperature from the last frame metadata',
+                  fn=lambda: camera.state.temperature)
 
     #
     # Install the unhandled exception processor. See above,
     #
     falc_app.add_error_handler(Exception, falcon_uncaught_exception_handler)
+    return falc_app
+
+def main():
+    """ Application startup"""
+
+    falc_app = create_app()
+
+    # ---------
+    # DISCOVERY
+    # ---------
+    _DSC = DiscoveryResponder(Config.ip_address, Config.port)
 
     # ------------------
     # SERVER APPLICATION
     # ------------------
     # Using the lightweight built-in Python wsgi.simple_server
     with make_server(Config.ip_address, Config.port, falc_app, handler_class=LoggingWSGIRequestHandler) as httpd:
-        logger.info(f'==STARTUP== Serving on {Config.ip_address}:{Config.port}. Time stamps are UTC.')
+        log.logger.info(f'==STARTUP== Serving on {Config.ip_address}:{Config.port}. Time stamps are UTC.')
         # Serve until process is killed
         httpd.serve_forever()
 
@@ -0,0 +1,15 @@
+from config import Config
+
+class BackendFactory:
+
+    @staticmethod
+    def get_camera_class():
+        # Import on demand so the simulator doesn't need picamera2 or libcamera installed
+        if Config.camera_backend == 'picamera2':
+            from backend.Picamera2Backend import Picamera2Backend
+            return Picamera2Backend
+        elif Config.camera_backend == 'simulator':
+            from backend.SimulatorBackend import SimulatorBackend
+            return SimulatorBackend
+        else:
+            raise Exception(f"Unknown camera backend {Config.camera_backend}")
@@ -0,0 +1,7 @@
+from picamera2 import Picamera2
+import libcamera
+from backend.backend import CameraBackend
+
+class Picamera2Backend(Picamera2, CameraBackend):
+    """A real camera, via Picamera2 and libcamera"""
+    noise_reduction_off = libcamera.controls.draft.NoiseReductionModeEnum.Off
@@ -0,0 +1,139 @@
+import time
+import threading
+import numpy as np
+from config import Config
+from backend.backend import CameraBackend
+from backend.synthetic import Scene
+
+# Time to read the sensor out after the exposure, scaled by time_scale like the exposure
+READOUT_TIME = 0.1
+MIN_EXPOSURE_US = 60
+
+class SimulatedControls:
+    """Stands in for picamera2's Controls. Any attribute may be set."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class SimulatedRequest:
+    def __init__(self, frame: np.ndarray, metadata: dict, backend):
+        self._frame = frame
+        self._metadata = metadata
+        self._backend = backend
+
+    def get_metadata(self) -> dict:
+        return self._metadata
+
+    def make_array(self, name: str) -> np.ndarray:
+        if name != 'raw':
+            raise Exception(f"Simulator only has a raw stream, not {name}")
+        # Unpacked raw arrives as bytes, just like Picamera2 gives us
+        return self._frame.view(np.uint8)
+
+    def release(self):
+        if self._frame is not None:
+            with self._backend._lock:
+                self._backend.unreleased -= 1
+        self._frame = None
+
+class SimulatedJob:
+    def __init__(self, signal_function):
+        self.signal_function = signal_function
+        self.event = threading.Event()
+        self.request = None
+        self.timer = None
+
+class SimulatorBackend(CameraBackend):
+    """A camera that renders synthetic frames from backend.synthetic at the
+    configured raw resolution, taking as long as the exposure would"""
+    noise_reduction_off = 0
+
+    def __init__(self, camera_num: int = 0):
+        self.started = False
+        self.controls = SimulatedControls()
+        self.controls.ExposureTime = 1000000
+        self.controls.AnalogueGain = 1.0
+        self.camera_config = None
+        self._scene = None
+        self._scenes = {}                       # By raw size, so binning changes don't re-render
+        self._frames = 0
+        self.unreleased = 0                     # Requests handed out and not yet released
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def global_camera_info():
+        return [{'Model': Config.simulator_model, 'Location': 2, 'Rotation': 0, 'Id': 'simulator', 'Num': 0}]
+
+    def create_still_configuration(self, main={}, queue=True, buffer_count=1, raw=None):
+        return {'main': main, 'queue': queue, 'buffer_count': buffer_count, 'raw': raw}
+
+    def configure(self, camera_config):
+        self.camera_config = camera_config
+        width, height = camera_config['raw']['size']
+        if (width, height) not in self._scenes:
+            self._scenes[(width, height)] = Scene(Config.simulator_scene, width, height, Config.simulator_seed)
+        self._scene = self._scenes[(width, height)]
+
+    def start(self):
+        if self.camera_config is None:
+            raise Exception("Camera must be configured before starting")
+        self.started = True
+
+    def stop(self):
+        self.stop_()
+        self.started = False
+
+    def stop_(self):
+        # Abandon any exposures in progress
+        with self._lock:
+            jobs, self._jobs = self._jobs, []
+        for job in jobs:
+            job.timer.cancel()
+
+    def close(self):
+        self.stop()
+
+    def capture_request(self, wait=None, signal_function=None):
+        if not self.started:
+            raise Exception("Camera is not started")
+        exposure_us = max(int(getattr(self.controls, 'ExposureTime', MIN_EXPOSURE_US)), MIN_EXPOSURE_US)
+        gain = float(getattr(self.controls, 'AnalogueGain', 1.0))
+        job = SimulatedJob(signal_function)
+        delay = (exposure_us / 1e6 + READOUT_TIME) * Config.simulator_time_scale
+        job.timer = threading.Timer(delay, self._expose, (job, exposure_us, gain))
+        job.timer.daemon = True
+        with self._lock:
+            self._jobs.append(job)
+        job.timer.start()
+        if wait or (wait is None and signal_function is None):
+            return self.wait(job)
+        return job
+
+    def _expose(self, job: SimulatedJob, exposure_us: int, gain: float):
+        with self._lock:
+            if job not in self._jobs:
+                return                          # Aborted
+            self._jobs.remove(job)
+            index = self._frames
+            self._frames += 1
+            self.unreleased += 1
+        frame = self._scene.frame(exposure_us / 1e6, gain, index)
+        metadata = {
+            'SensorTimestamp': time.monotonic_ns(),
+            'ExposureTime': exposure_us,
+            'AnalogueGain': max(gain, 1.0),
+            'FrameDuration': exposure_us + int(READOUT_TIME * 1e6),
+            'SensorTemperature': Config.simulator_temperature,
+        }
+        job.request = SimulatedRequest(frame, metadata, self)
+        job.event.set()
+        if job.signal_function is not None:
+            job.signal_function(job)
+
+    def wait(self, job: SimulatedJob):
+        job.event.wait()
+        return job.request
@@ -0,0 +1,52 @@
+from abc import ABC, abstractmethod
+
+class CameraBackend(ABC):
+    """The part of the Picamera2 API that the driver uses.
+
+    Implementations also have a ``started`` attribute, a ``camera_config``
+    attribute holding the configuration in use, a ``controls`` attribute that
+    works as a context manager for setting controls, and a
+    ``noise_reduction_off`` attribute holding the NoiseReductionMode control
+    value that turns noise reduction off.
+    """
+
+    @staticmethod
+    @abstractmethod
+    def global_camera_info():
+        """List of dicts describing each attached camera, with at least 'Model'"""
+        pass
+
+    @abstractmethod
+    def create_still_configuration(self, main={}, queue=True, buffer_count=1, raw=None):
+        pass
+
+    @abstractmethod
+    def configure(self, camera_config):
+        pass
+
+    @abstractmethod
+    def start(self):
+        pass
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+    @abstractmethod
+    def stop_(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    @abstractmethod
+    def capture_request(self, wait=None, signal_function=None):
+        """Start capturing a request. Returns a job, and calls signal_function(job) when done"""
+        pass
+
+    @abstractmethod
+    def wait(self, job):
+        """Wait for a job and return its request. The request has get_metadata(),
+        make_array('raw') and release()"""
+        pass
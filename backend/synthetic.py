@@ -0,0 +1,83 @@
+# Deterministic synthetic raw frames for the simulator and benchmarks.
+#
+# A Scene precomputes, once, the rate at which each pixel collects signal
+# (ADU per second at unity gain) and a pool of unit gaussian noise. Each frame
+# is then just rate * exposure * gain + bias plus scaled noise, with the noise
+# pool rolled by the frame number, so frame N is always the same frame N.
+import numpy as np
+
+BIAS = 256                      # 12 bit ADU
+READ_NOISE = 3.0                # ADU
+MAX_ADU = 4095                  # 12 bit sensor
+
+# Per channel response of a BGGR sensor to a white-ish source, in Bayer order
+_CHANNELS = ((0.6, 1.0), (1.0, 0.8))
+
+
+def _bayer(rate: np.ndarray):
+    for y in range(2):
+        for x in range(2):
+            rate[y::2, x::2] *= _CHANNELS[y][x]
+
+
+def _stars(width: int, height: int, rng) -> np.ndarray:
+    rate = np.full((height, width), 20.0, dtype=np.float32)                 # Sky background
+    r = 7
+    yy, xx = np.mgrid[-r:r + 1, -r:r + 1]
+    count = max(width * height // 20000, 1)
+    xs = rng.integers(r, width - r - 1, count)
+    ys = rng.integers(r, height - r - 1, count)
+    peaks = 10 ** rng.uniform(1, 3.5, count)                                # ADU/s
+    sigmas = rng.uniform(1.0, 2.0, count)
+    for x, y, peak, sigma in zip(xs, ys, peaks, sigmas):
+        rate[y - r:y + r + 1, x - r:x + r + 1] += peak * np.exp(-(xx ** 2 + yy ** 2) / (2 * sigma ** 2))
+    _bayer(rate)
+    return rate
+
+
+def _dark(width: int, height: int, rng) -> np.ndarray:
+    rate = np.full((height, width), 0.5, dtype=np.float32)                  # Dark current
+    hot = rng.choice(width * height, max(width * height // 20000, 1), replace=False)
+    rate.flat[hot] = rng.uniform(20, 500, hot.size)                        # Hot pixels
+    return rate
+
+
+def _flat(width: int, height: int, rng) -> np.ndarray:
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    r2 = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / ((width / 2) ** 2)
+    rate = (20000 * (1 - 0.3 * r2)).astype(np.float32)                     # Vignetted panel
+    _bayer(rate)
+    return rate
+
+
+_KINDS = {
+    'stars': _stars,
+    'dark': _dark,
+    'flat': _flat,
+}
+
+
+class Scene:
+    def __init__(self, kind: str, width: int, height: int, seed: int = 1):
+        if kind not in _KINDS:
+            raise ValueError(f"Unknown scene {kind}")
+        rng = np.random.default_rng(seed)
+        self.kind = kind
+        self.width = width
+        self.height = height
+        self.rate = _KINDS[kind](width, height, rng)
+        if kind != 'dark':
+            self.rate += _dark(width, height, rng)
+        self.noise = rng.standard_normal((height, width), dtype=np.float32)
+
+    def frame(self, exposure: float, gain: float = 1.0, index: int = 0) -> np.ndarray:
+        """A 12 bit raw frame as uint16, exposure in seconds"""
+        gain = max(gain, 1.0)
+        signal = self.rate * (exposure * gain)
+        # Shot noise plus read noise, then bias
+        sigma = np.sqrt(signal * gain + READ_NOISE ** 2)
+        noise = np.roll(self.noise, index * 7919)
+        signal += sigma * noise
+        signal += BIAS
+        np.clip(signal, 0, MAX_ADU, out=signal)
+        return signal.astype(np.uint16)
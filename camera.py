@@ -15,15 +15,24 @@
 from falcon import Request, Response, HTTPBadRequest, before
 import logging
 from shr import ImageArrayResponse, PropertyResponse, MethodResponse, PreProcessRequest, \
-                get_request_field, to_bool #, to_int, to_float
+                get_request_field, to_bool, SHUFFLE_CONTENT_TYPE #, to_int, to_float
 from exceptions import *        # Nothing but exception
-from picamera2 import Picamera2
 from camerastate import CameraState
 from sensor.SensorFactory import SensorFactory
+from backend.BackendFactory import BackendFactory
 from state import State
-import libcamera
 import numpy as np
 import threading
+import time
+import timing
+import metrics
+import capture
+import recorder
+import orjson
+from config import Config
+from imaging import calibration, hotpixels, stars, guiding, flats, photometry, lucky, allsky, meteors, render
+import os
+from profiler import profiler
 
 logger: Logger = None
 state = State()
@@ -55,6 +64,7 @@ class CameraMetadata:
 
 # Camera Init
 picam2 = None
+Camera = None                   # Picamera2, or the simulator. See config.toml
 def start_camera_device(logger: logger):
     logger = logger
 
@@ -63,19 +73,740 @@ def start_camera_device(logger: logger):
     sensor = SensorFactory.get_sensor()
     state.num_x = sensor.get_size_x()
     state.num_y = sensor.get_size_y()
+    state.calibrate = Config.calibration_apply
+    state.correct_hotpixels = Config.hotpixel_correct
     
     # Initialize PiCamera2
-    global picam2
-    picam2 = Picamera2()
+    global picam2, Camera
+    Camera = BackendFactory.get_camera_class()
+    picam2 = Camera()
 
 def get_config():
     return picam2.create_still_configuration( {"size": (640, 480)}, queue=False, buffer_count=2,  raw={'format': sensor.get_raw_format(),'size': (int(sensor.get_size_x() / state.binning), int(sensor.get_size_y() / state.binning))})
 
+# Restart the camera with the exposure and the current gain
+def _apply_controls(exposure: float):
+    picam2.stop()
+    with picam2.controls as controls:
+        controls.ExposureTime = int(exposure * 1e6)
+        controls.AeEnable = False
+        controls.NoiseReductionMode = picam2.noise_reduction_off
+        controls.AwbEnable = False
+        controls.AnalogueGain = state.gainvalue
+    picam2.start()
+
+# Switch the camera resolution when the binning changes
+def _set_binning(binning: int):
+    if binning != state.binning:
+        state.binning = binning
+        picam2.stop()
+        picam2.configure(get_config())
+        picam2.start()
+        metrics.pipeline_restart('binning')
+
+# Stop a capture part way through. The camera is replaced, as there's no way
+# to cancel a request that's already queued
+def _reset_camera():
+    global picam2
+    if state.frame_loop is not None:
+        state.frame_loop.stop()
+        state.frame_loop = None
+    picam2.stop_()
+    picam2.stop()
+    picam2.close()
+    picam2 = Camera()
+    picam2.configure(get_config())
+    picam2.start()
+    state.need_restart = True       # A new camera, so the controls must be set again
+    state.camerastate = CameraState.IDLE
+
+# Camera is exposing, stacking, guiding or building a master
+def _busy() -> bool:
+    return state.camerastate == CameraState.EXPOSING or \
+        (state.frame_loop is not None and state.frame_loop.is_alive())
+
+# -------
+# ACTIONS
+# -------
+# Each takes the Parameters (decoded from JSON) and returns the Action's value.
+# Raise ValueError for bad parameters, or RuntimeError if it can't be done now.
+_library = None
+def calibration_library() -> calibration.Library:
+    global _library
+    if _library is None:
+        _library = calibration.Library(Config.calibration_library)
+    return _library
+
+def _calibration_capture(parameters: dict):
+    """Capture and combine frames into a master in the library, in the background.
+    Parameters: kind (bias, dark or flat), exposure, count, gain, binning,
+    method (sigma, median, mean or minmax) and download (return the master from imagearray)."""
+    kind = parameters.get('kind')
+    if kind not in calibration.KINDS:
+        raise ValueError(f'kind must be one of {", ".join(calibration.KINDS)}')
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    exposure = float(parameters.get('exposure', sensor.get_min_exposure() if kind == 'bias' else -1))
+    if exposure < sensor.get_min_exposure() or exposure > sensor.get_max_exposure():
+        raise ValueError(f'exposure must be between {sensor.get_min_exposure()} and {sensor.get_max_exposure()}')
+    count = int(parameters.get('count', Config.calibration_frames))
+    gain = int(parameters.get('gain', state.gainvalue))
+    binning = int(parameters.get('binning', state.binning))
+    method = parameters.get('method', Config.calibration_method)
+    if count < 1 or not sensor.get_min_gain() <= gain <= sensor.get_max_gain() \
+            or not 1 <= binning <= sensor.get_max_binning():
+        raise ValueError('Bad count, gain or binning')
+    download = bool(parameters.get('download', False))
+    # Before changing anything, as it's what checks the method
+    shape = (sensor.get_size_y() // binning, sensor.get_size_x() // binning)
+    combiner = calibration.combiner(count, shape, Config.calibration_library, method,
+                                    Config.calibration_sigma, Config.calibration_band_mb * 1024 * 1024)
+
+    _set_binning(binning)
+    state.gainvalue = gain
+    state.last_duration = exposure
+    _apply_controls(exposure)
+    state.need_restart = False
+
+    state.calibration = {'state': 'capturing', 'kind': kind, 'count': count, 'frames': 0}
+    started = time.perf_counter()
+
+    def consumer(array, metadata, index):
+        combiner.add(array, metadata, index)
+        state.calibration['frames'] = combiner.frames
+        state.calibration['fps'] = round(combiner.frames / (time.perf_counter() - started), 2)
+
+    def done(loop: capture.FrameLoop):
+        try:
+            if loop.error is not None:
+                raise loop.error
+            state.calibration['state'] = 'combining'
+            t0 = time.perf_counter()
+            master = calibration.Master(kind, sensor.get_name(), gain, exposure, binning,
+                                        combiner.temperature, combiner.frames)
+            array = combiner.combine()
+            calibration_library().add(master, array)
+            logger.info(f'Combined {combiner.frames} frames in {time.perf_counter() - t0:.1f}s')
+            state.calibration.update({'state': 'done', 'master': master.file})
+            if download:
+                state.stacked = (np.round(array).astype(np.uint16), 12, {'SensorTemperature': master.temperature},
+                                 None)       # Not to be calibrated
+                state.imageReady = True
+        except Exception as ex:
+            logger.error(f'Calibration capture failed: {ex}')
+            state.calibration.update({'state': 'failed', 'error': str(ex)})
+        finally:
+            combiner.close()
+            metrics.frames_captured.inc(loop.frames)
+            state.camerastate = CameraState.IDLE
+
+    logger.info(f'Capturing {count} x {exposure}s {kind} frames for a master')
+    state.imageReady = False
+    state.camerastate = CameraState.EXPOSING
+    state.frame_loop = capture.FrameLoop(picam2, consumer, count, done, 'Calibration')
+    state.frame_loop.start()
+    return orjson.dumps(state.calibration).decode()
+
+def _bias_burst(parameters: dict):
+    """A bias master from count (default 100) frames at the shortest exposure,
+    captured back to back at the full frame rate and combined as they arrive
+    (method minmax). Otherwise as CalibrationCapture."""
+    parameters = dict(parameters, kind='bias', exposure=sensor.get_min_exposure())
+    parameters.setdefault('count', 100)
+    parameters.setdefault('method', 'minmax')
+    return _calibration_capture(parameters)
+
+def _calibration_status(parameters: dict):
+    """Progress of the last CalibrationCapture, and the masters applied to the last frame"""
+    status = dict(state.calibration or {'state': 'idle'})
+    status['apply'] = state.calibrate
+    if _calibrator is not None:
+        status['applied'] = _calibrator.selected
+    return orjson.dumps(status).decode()
+
+_calibrator = None
+def calibrator() -> calibration.Calibrator:
+    global _calibrator
+    if _calibrator is None:
+        # Frames are calibrated as 12 bit raw data, before the shift up to MaxADU,
+        # so they clip at the raw maximum or the shift would overflow
+        _calibrator = calibration.Calibrator(calibration_library(), Config.calibration_cache,
+                                             Config.calibration_pedestal, raw_max=(1 << 12) - 1)
+    return _calibrator
+
+def _calibration_apply(parameters: dict):
+    """Turn calibration of downloaded frames on or off: {"enabled": true}"""
+    if 'enabled' in parameters:
+        state.calibrate = bool(parameters['enabled'])
+    return orjson.dumps({'apply': state.calibrate}).decode()
+
+def _calibration_masters(parameters: dict):
+    """The masters in the library, optionally of one kind"""
+    return orjson.dumps([m.as_dict() for m in calibration_library().masters(parameters.get('kind'))]).decode()
+
+# Hot pixel maps, by binning, loaded when first needed
+_hotpixel_maps = {}
+def _hotpixel_file(binning: int) -> str:
+    return os.path.join(Config.calibration_library, f'hotpixels-{sensor.get_name()}-b{binning}.npy')
+
+def hotpixel_map(binning: int) -> hotpixels.HotPixelMap:
+    if binning not in _hotpixel_maps:
+        path = _hotpixel_file(binning)
+        width, height = sensor.get_size_x() // binning, sensor.get_size_y() // binning
+        _hotpixel_maps[binning] = hotpixels.HotPixelMap.load(path, width, height) if os.path.exists(path) else None
+    return _hotpixel_maps[binning]
+
+def _save_hotpixel_map(dark: np.ndarray, binning: int) -> int:
+    indices = hotpixels.detect(dark, Config.hotpixel_sigma, Config.hotpixel_min_excess)
+    hp = hotpixels.HotPixelMap(indices, dark.shape[1], dark.shape[0])
+    os.makedirs(Config.calibration_library, exist_ok=True)
+    hp.save(_hotpixel_file(binning))
+    _hotpixel_maps[binning] = hp
+    logger.info(f'Found {len(hp)} hot pixels at bin {binning}')
+    return len(hp)
+
+def _hotpixel_map(parameters: dict):
+    """Build the hot pixel map for the current binning. With exposure (and
+    count), from that many dark frames taken now, in the background; otherwise
+    from the nearest master dark."""
+    binning = state.binning
+    if 'exposure' not in parameters:
+        dark = calibrator().nearest('dark', sensor.get_name(), state.gainvalue, state.last_duration,
+                                    binning, state.temperature)
+        if dark is None:
+            raise RuntimeError(f'No master dark at bin {binning}')
+        return orjson.dumps({'pixels': _save_hotpixel_map(calibration_library().load(dark), binning),
+                             'dark': dark.file}).decode()
+
+    exposure = float(parameters['exposure'])
+    count = int(parameters.get('count', 10))
+    if exposure < sensor.get_min_exposure() or exposure > sensor.get_max_exposure() or count < 1:
+        raise ValueError('Bad exposure or count')
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    state.last_duration = exposure
+    _apply_controls(exposure)
+    state.need_restart = False
+    width, height = sensor.get_size_x() // binning, sensor.get_size_y() // binning
+    stacker = capture.Stacker(0, 0, width, height, 'mean')
+
+    def done(loop: capture.FrameLoop):
+        try:
+            if loop.error is None:
+                _save_hotpixel_map(stacker.result()[0], binning)
+        except Exception as ex:
+            logger.error(f'Hot pixel map failed: {ex}')
+        finally:
+            metrics.frames_captured.inc(loop.frames)
+            state.camerastate = CameraState.IDLE
+
+    logger.info(f'Capturing {count} x {exposure}s darks for the hot pixel map')
+    state.imageReady = False
+    state.camerastate = CameraState.EXPOSING
+    state.frame_loop = capture.FrameLoop(picam2, stacker.add, count, done, 'HotPixels')
+    state.frame_loop.start()
+    return orjson.dumps({'building': True}).decode()
+
+def _hotpixel_correct(parameters: dict):
+    """Turn hot pixel correction of downloaded frames on or off: {"enabled": true}"""
+    if 'enabled' in parameters:
+        state.correct_hotpixels = bool(parameters['enabled'])
+    hp = hotpixel_map(state.binning)
+    return orjson.dumps({'enabled': state.correct_hotpixels, 'pixels': len(hp) if hp is not None else None}).decode()
+
+def _analyze_stars(parameters: dict):
+    """Stars in the last frame downloaded: count, median HFR and FWHM (raw
+    pixels), background and noise (ADU as downloaded). Parameters: threshold (x noise),
+    binning (of the luminance plane, for speed), list (include x, y, flux,
+    hfr and fwhm of each star, relative to the subframe) and max_stars."""
+    frame = state.last_frame
+    if frame is None:
+        raise RuntimeError('No frame has been captured')
+    threshold = float(parameters.get('threshold', 5.0))
+    binning = int(parameters.get('binning', 1))
+    max_stars = int(parameters.get('max_stars', 500))
+    if threshold <= 0 or binning < 1 or max_stars < 1:
+        raise ValueError('Bad threshold, binning or max_stars')
+    t0 = time.perf_counter()
+    result = stars.analyze(frame['array'], threshold, binning, frame['saturation'], max_stars)
+    result['frame'] = frame['id']
+    result['seconds'] = round(time.perf_counter() - t0, 3)
+    if not parameters.get('list', False):
+        del result['list']
+    return orjson.dumps(result).decode()
+
+def _check_exposure(exposure: float, gain: int):
+    if exposure < sensor.get_min_exposure() or exposure > sensor.get_max_exposure():
+        raise ValueError(f'Exposure must be between {sensor.get_min_exposure()} and {sensor.get_max_exposure()}')
+    if gain < sensor.get_min_gain() or gain > sensor.get_max_gain():
+        raise ValueError(f'Gain must be between {sensor.get_min_gain()} and {sensor.get_max_gain()}')
+
+def _run_continuously(consumer, exposure: float, gain: int, name: str, count: int = None, on_done=None):
+    """Capture frames back to back for consumer until stopped with _stop_continuous,
+    or count of them, then call on_done(loop)"""
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    state.gainvalue = gain
+    state.last_duration = exposure
+    _apply_controls(exposure)
+    state.need_restart = False
+
+    def done(loop: capture.FrameLoop):
+        # At the end of count frames, or if the capture failed
+        try:
+            if on_done is not None:
+                on_done(loop)
+        finally:
+            metrics.frames_captured.inc(loop.frames)
+            state.camerastate = CameraState.IDLE
+
+    state.imageReady = False
+    state.camerastate = CameraState.EXPOSING
+    state.frame_loop = capture.FrameLoop(picam2, consumer, count, done, name)
+    state.frame_loop.start()
+
+def _running(consumer) -> bool:
+    """Whether frames are being captured for consumer"""
+    return state.frame_loop is not None and state.frame_loop.is_alive() and state.frame_loop.consumer == consumer
+
+def _stop_continuous(consumer):
+    if _running(consumer):
+        name = state.frame_loop.name.lower()
+        metrics.frames_captured.inc(state.frame_loop.frames)
+        _reset_camera()
+        metrics.pipeline_restart(name)
+
+def _guide_start(parameters: dict):
+    """Capture continuously, measuring the guide star in a box around x, y
+    (binned sensor pixels) in each frame. Parameters: x, y, exposure, and
+    optionally box (size in pixels), gain and threshold (x noise)."""
+    try:
+        x, y, exposure = float(parameters['x']), float(parameters['y']), float(parameters['exposure'])
+    except KeyError as ex:
+        raise ValueError(f'Missing {ex}')
+    size = int(parameters.get('box', Config.guide_box))
+    gain = int(parameters.get('gain', state.gainvalue))
+    threshold = float(parameters.get('threshold', 5.0))
+    width, height = sensor.get_size_x() // state.binning, sensor.get_size_y() // state.binning
+    if not (0 <= x < width and 0 <= y < height) or size < 8 or size > min(width, height) or threshold <= 0:
+        raise ValueError('Bad x, y, box or threshold')
+    _check_exposure(exposure, gain)
+    guider = guiding.Guider(x, y, size, threshold, Config.guide_history)
+    _run_continuously(guider.add, exposure, gain, 'Guiding')
+    state.guider = guider
+    logger.info(f'Guiding on {x:.0f}, {y:.0f} with {exposure}s frames')
+    return orjson.dumps({'guiding': True}).decode()
+
+def _guide_records(parameters: dict):
+    """Guide records after sequence number since (default 0, all that are kept)"""
+    if state.guider is None:
+        raise RuntimeError('Not guiding')
+    records = state.guider.records(int(parameters.get('since', 0)))
+    return orjson.dumps({'guiding': _running(state.guider.add), 'last': state.guider.sequence,
+                         'lost': state.guider.lost, 'records': records}).decode()
+
+def _guide_stop(parameters: dict):
+    """Stop guiding. The records stay readable until the next GuideStart"""
+    if state.guider is not None:
+        _stop_continuous(state.guider.add)
+    return orjson.dumps({'guiding': False, 'last': state.guider.sequence if state.guider else 0}).decode()
+
+def _photometry_start(parameters: dict):
+    """Capture continuously, measuring apertures at fixed positions in each
+    frame. Parameters: positions ([[x, y], ...] in binned sensor pixels, the
+    target first), exposure, and optionally radius, inner and outer (of the
+    background annulus) and gain."""
+    try:
+        positions = [(float(x), float(y)) for x, y in parameters['positions']]
+        exposure = float(parameters['exposure'])
+    except KeyError as ex:
+        raise ValueError(f'Missing {ex}')
+    except TypeError:
+        raise ValueError('positions must be a list of [x, y]')
+    if not positions:
+        raise ValueError('No positions')
+    gain = int(parameters.get('gain', state.gainvalue))
+    _check_exposure(exposure, gain)
+    ring = photometry.Ring(Config.photometry_history, len(positions))
+    photometer = photometry.Photometer(positions, float(parameters.get('radius', Config.photometry_radius)),
+                                       float(parameters.get('inner', Config.photometry_inner)),
+                                       float(parameters.get('outer', Config.photometry_outer)), ring)
+    if not photometer.fits(sensor.get_size_x() // state.binning, sensor.get_size_y() // state.binning):
+        raise ValueError('An aperture is too close to the edge of the frame')
+    _run_continuously(photometer.add, exposure, gain, 'Photometry')
+    state.photometer = photometer
+    logger.info(f'Photometry of {len(positions)} stars with {exposure}s frames')
+    return orjson.dumps({'running': True, 'area': photometer.area.tolist()}).decode()
+
+def _photometry_read(parameters: dict):
+    """Rows after sequence number since (default 0), at most limit of them,
+    as columns: n, t (SensorTimestamp, s), exposure (s), and flux and background
+    (ADU) for each aperture. clock adds to t to make it Unix time."""
+    if state.photometer is None:
+        raise RuntimeError('Photometry has not been started')
+    limit = parameters.get('limit')
+    rows = state.photometer.ring.read(int(parameters.get('since', 0)), None if limit is None else int(limit))
+    rows.update({'running': _running(state.photometer.add), 'last': state.photometer.ring.sequence,
+                 'clock': time.time() - time.monotonic()})
+    return orjson.dumps(rows).decode()
+
+def _photometry_stop(parameters: dict):
+    """Stop photometry. The rows stay readable until the next PhotometryStart"""
+    if state.photometer is not None:
+        _stop_continuous(state.photometer.add)
+    return orjson.dumps({'running': False,
+                         'last': state.photometer.ring.sequence if state.photometer else 0}).decode()
+
+def _lucky_capture(parameters: dict):
+    """Capture a burst of count frames over the subframe, keeping the keep
+    sharpest, then align and stack them for the next imagearray, in the
+    background. Parameters: exposure, and optionally count, keep, gain, align
+    (default true) and output (stack, the default, or best for the sharpest
+    frame alone)."""
+    try:
+        exposure = float(parameters['exposure'])
+    except KeyError as ex:
+        raise ValueError(f'Missing {ex}')
+    count = int(parameters.get('count', Config.lucky_count))
+    keep = int(parameters.get('keep', Config.lucky_keep))
+    gain = int(parameters.get('gain', state.gainvalue))
+    align = bool(parameters.get('align', True))
+    output = parameters.get('output', 'stack')
+    if count < 1 or not 1 <= keep <= count or output not in ('stack', 'best'):
+        raise ValueError('Bad count, keep or output')
+    if keep * state.num_x * state.num_y * 2 > Config.lucky_max_mb * 1024 * 1024:
+        raise ValueError(f'Keeping {keep} frames of the subframe needs more than {Config.lucky_max_mb}MB')
+    _check_exposure(exposure, gain)
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    state.gainvalue = gain
+    state.last_duration = exposure
+    _apply_controls(exposure)
+    state.need_restart = False
+    selector = lucky.Selector(keep, state.start_x, state.start_y, state.num_x, state.num_y)
+    state.lucky = {'state': 'capturing', 'count': count, 'keep': keep, 'selector': selector}
+
+    def done(loop: capture.FrameLoop):
+        try:
+            if loop.error is not None:
+                raise loop.error
+            state.lucky['state'] = 'stacking'
+            t0 = time.perf_counter()
+            array = selector.stack(align) if output == 'stack' else selector.best()
+            logger.info(f'Lucky {output} of {selector.status()["kept"]} frames in {time.perf_counter() - t0:.1f}s')
+            state.stacked = (array, 12, selector.metadata, selector.origin)
+            state.imageReady = True
+            state.lucky['state'] = 'done'
+        except Exception as ex:
+            logger.error(f'Lucky imaging failed: {ex}')
+            state.lucky.update({'state': 'failed', 'error': str(ex)})
+        finally:
+            metrics.frames_captured.inc(loop.frames)
+            state.camerastate = CameraState.IDLE
+
+    logger.info(f'Lucky imaging {count} x {exposure}s, keeping {keep}')
+    state.imageReady = False
+    state.stacked = None
+    state.camerastate = CameraState.EXPOSING
+    state.frame_loop = capture.FrameLoop(picam2, selector.add, count, done, 'Lucky')
+    state.frame_loop.start()
+    return _lucky_status({})
+
+def _lucky_status(parameters: dict):
+    """Progress of the last LuckyCapture, with the sharpness scores: the mean of
+    all frames, and the best and worst of those kept"""
+    if state.lucky is None:
+        return orjson.dumps({'state': 'idle'}).decode()
+    status = {k: v for k, v in state.lucky.items() if k != 'selector'}
+    status.update(state.lucky['selector'].status())
+    return orjson.dumps(status).decode()
+
+def _record_start(parameters: dict):
+    """Record the subframe of every frame to an SER file on the Pi, until
+    RecordStop or count frames. Parameters: exposure, and optionally count,
+    gain and name (of the file, in the recording directory)."""
+    try:
+        exposure = float(parameters['exposure'])
+    except KeyError as ex:
+        raise ValueError(f'Missing {ex}')
+    count = parameters.get('count')
+    count = None if count is None else int(count)
+    gain = int(parameters.get('gain', state.gainvalue))
+    name = os.path.basename(str(parameters.get('name', time.strftime('%Y%m%d-%H%M%S'))))
+    if count is not None and count < 1:
+        raise ValueError('Bad count')
+    _check_exposure(exposure, gain)
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    os.makedirs(Config.recording_directory, exist_ok=True)
+    path = os.path.join(Config.recording_directory, name if name.endswith('.ser') else name + '.ser')
+    bayer = sensor.get_bayer_pattern()
+    writer = recorder.SerWriter(path, state.num_x, state.num_y,
+                                recorder.bayer_name(bayer.get_offset_x(), bayer.get_offset_y(),
+                                                    state.start_x, state.start_y),
+                                12, sensor.get_name(), Config.recording_observer, Config.recording_telescope, count)
+    rec = recorder.Recorder(writer, state.start_x, state.start_y, state.num_x, state.num_y,
+                            Config.recording_buffers)
+
+    def done(loop: capture.FrameLoop):
+        rec.close()
+        logger.info(f'Recorded {writer.frames} frames to {path}')
+
+    try:
+        _run_continuously(rec.add, exposure, gain, 'Recording', count, done)
+    except Exception:
+        rec.close()
+        os.remove(path)
+        raise
+    state.recorder = rec
+    logger.info(f'Recording {exposure}s frames to {path}')
+    return orjson.dumps(rec.status()).decode()
+
+def _record_status(parameters: dict):
+    """Frames captured, written, dropped (the disk didn't keep up) and missed
+    (the capture didn't), frame rate and throughput of the last recording"""
+    if state.recorder is None:
+        return orjson.dumps({'recording': False}).decode()
+    status = state.recorder.status()
+    status['recording'] = _running(state.recorder.add)
+    return orjson.dumps(status).decode()
+
+def _record_stop(parameters: dict):
+    """Stop recording and finish the file"""
+    if state.recorder is not None and _running(state.recorder.add):
+        _stop_continuous(state.recorder.add)
+        state.recorder.close()
+        logger.info(f'Recorded {state.recorder.writer.frames} frames to {state.recorder.writer.path}')
+    return _record_status(parameters)
+
+def _allsky_frame(array: np.ndarray, metadata: dict, index: int):
+    state.allsky.add(array, metadata, index)
+    # The latest frame is the one to analyse
+    state.frame_id += 1
+    state.last_frame = {'array': array, 'origin': (0, 0), 'bits': 12, 'metadata': metadata,
+                        'saturation': 0.95 * 0xfff, 'id': state.frame_id}
+
+def _allsky_start(parameters: dict):
+    """All-sky camera mode: a frame every interval seconds, with auto exposure,
+    a preview, and the night's keogram and star trails, in the allsky directory.
+    Optional interval, exposure (the first) and gain."""
+    interval = float(parameters.get('interval', Config.allsky_interval))
+    exposure = float(parameters.get('exposure', 1.0))
+    gain = int(parameters.get('gain', state.gainvalue))
+    if interval <= 0:
+        raise ValueError('Bad interval')
+    _check_exposure(exposure, gain)
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    bayer = sensor.get_bayer_pattern()
+    sky = allsky.AllSky(Config.allsky_directory, bayer.get_offset_x(), bayer.get_offset_y(), exposure,
+                        sensor.get_min_exposure(), min(Config.allsky_max_exposure, sensor.get_max_exposure()),
+                        Config.allsky_target, Config.allsky_black, Config.allsky_night_exposure,
+                        Config.allsky_size)
+    state.gainvalue = gain
+    state.last_duration = exposure
+    _apply_controls(exposure)
+
+    def before(loop: capture.IntervalLoop):
+        if sky.exposure != state.last_duration:
+            state.last_duration = sky.exposure
+            _apply_controls(sky.exposure)
+
+    def done(loop: capture.IntervalLoop):
+        # Only if the capture failed
+        sky.save()
+        metrics.frames_captured.inc(loop.frames)
+        state.camerastate = CameraState.IDLE
+
+    state.allsky = sky
+    state.need_restart = False
+    state.imageReady = False
+    state.camerastate = CameraState.EXPOSING
+    state.frame_loop = capture.IntervalLoop(picam2, _allsky_frame, interval, before, done, 'AllSky')
+    state.frame_loop.start()
+    logger.info(f'All-sky mode, every {interval}s')
+    return _allsky_status({})
+
+def _allsky_status(parameters: dict):
+    """Frames taken, the last frame's exposure and level, and the next exposure"""
+    if state.allsky is None:
+        return orjson.dumps({'running': False}).decode()
+    status = state.allsky.status()
+    status['running'] = _running(_allsky_frame)
+    return orjson.dumps(status).decode()
+
+def _allsky_stop(parameters: dict):
+    """Stop all-sky mode, writing the keogram and star trails so far"""
+    if state.allsky is not None:
+        _stop_continuous(_allsky_frame)
+        state.allsky.save()
+    return _allsky_status(parameters)
+
+def _meteor_start(parameters: dict):
+    """Capture continuously over the subframe, detecting meteors and other
+    transients, and record a clip of each to an SER file in the meteors
+    directory. Parameters: exposure, and optionally gain, threshold (x each
+    pixel's standard deviation) and min_pixels."""
+    try:
+        exposure = float(parameters['exposure'])
+    except KeyError as ex:
+        raise ValueError(f'Missing {ex}')
+    gain = int(parameters.get('gain', state.gainvalue))
+    threshold = float(parameters.get('threshold', Config.meteor_threshold))
+    min_pixels = int(parameters.get('min_pixels', Config.meteor_min_pixels))
+    if threshold <= 0 or min_pixels < 1:
+        raise ValueError('Bad threshold or min_pixels')
+    _check_exposure(exposure, gain)
+    bayer = sensor.get_bayer_pattern()
+    monitor = meteors.Monitor(meteors.Detector(Config.meteor_binning, threshold, min_pixels),
+                              state.start_x, state.start_y, state.num_x, state.num_y, Config.meteor_directory,
+                              Config.meteor_pre, Config.meteor_post, Config.meteor_max_clip,
+                              recorder.bayer_name(bayer.get_offset_x(), bayer.get_offset_y(),
+                                                  state.start_x, state.start_y), sensor.get_name())
+    _run_continuously(monitor.add, exposure, gain, 'Meteors', on_done=lambda loop: monitor.close())
+    state.meteors = monitor
+    logger.info(f'Meteor detection with {exposure}s frames')
+    return _meteor_status({})
+
+def _meteor_status(parameters: dict):
+    """Frames checked, clips recorded, and the events after sequence number
+    since (default 0): kind (line or point), pixels, x, y, length, peak (sigma),
+    time and the clip file"""
+    if state.meteors is None:
+        return orjson.dumps({'running': False}).decode()
+    return orjson.dumps({'running': _running(state.meteors.add), 'frames': state.meteors.detector.frames,
+                         'clips': state.meteors.clips, 'last': state.meteors.sequence,
+                         'events': state.meteors.events(int(parameters.get('since', 0)))}).decode()
+
+def _meteor_stop(parameters: dict):
+    """Stop meteor detection, finishing any clip being recorded"""
+    if state.meteors is not None and _running(state.meteors.add):
+        _stop_continuous(state.meteors.add)
+        state.meteors.close()
+    return _meteor_status(parameters)
+
+def _flat_exposure(parameters: dict):
+    """Find the exposure giving a flat of mean level target (ADU as downloaded,
+    out of MaxADU), within tolerance (a fraction, default 0.05), from trial
+    frames measured on the Pi, in the background. Optional start (first
+    exposure to try), gain and region (central fraction of the frame measured,
+    default 0.5). FlatStatus has the result."""
+    max_adu = sensor.get_max_adu()
+    target = float(parameters.get('target', max_adu / 2))
+    tolerance = float(parameters.get('tolerance', 0.05))
+    region = float(parameters.get('region', 0.5))
+    gain = int(parameters.get('gain', state.gainvalue))
+    if not 0 < tolerance < 1 or not 0 < region <= 1:
+        raise ValueError('Bad tolerance or region')
+    if gain < sensor.get_min_gain() or gain > sensor.get_max_gain():
+        raise ValueError(f'Gain must be between {sensor.get_min_gain()} and {sensor.get_max_gain()}')
+    scale = (max_adu + 1) / (1 << 12)   # The 12 bit raw data is shifted up on download
+    solver = flats.ExposureSolver(target, tolerance, sensor.get_min_exposure(), sensor.get_max_exposure(),
+                                  max_adu, float(parameters.get('start', state.last_duration or 1.0)))
+    if _busy():
+        raise RuntimeError('The camera is busy')
+    state.gainvalue = gain
+    state.flat_solve = {'state': 'solving', 'target': target, 'trials': solver.trials}
+
+    def consumer(array, metadata, index):
+        # The exposure actually used, which may be rounded to a whole line time
+        solver.add(metadata['ExposureTime'] / 1e6, flats.level(array, region) * scale)
+
+    def trial(exposure: float):
+        state.last_duration = exposure
+        _apply_controls(exposure)
+        state.frame_loop = capture.FrameLoop(picam2, consumer, 1, done, 'FlatExposure')
+        state.frame_loop.start()
+
+    def done(loop: capture.FrameLoop):
+        try:
+            metrics.frames_captured.inc(loop.frames)
+            if loop.error is not None:
+                raise loop.error
+            exposure = solver.next()
+            if exposure is not None:
+                trial(exposure)         # Runs on, in a new loop
+                return
+            if solver.error is not None:
+                raise RuntimeError(solver.error)
+            state.flat_solve.update({'state': 'done', 'exposure': solver.exposure, 'level': solver.trials[-1][1]})
+            logger.info(f'Flat exposure {solver.exposure:.4f}s after {len(solver.trials)} trials')
+        except Exception as ex:
+            logger.error(f'Flat exposure failed: {ex}')
+            state.flat_solve.update({'state': 'failed', 'error': str(ex)})
+        state.camerastate = CameraState.IDLE
+
+    logger.info(f'Finding the flat exposure for {target:.0f} ADU')
+    state.imageReady = False
+    state.camerastate = CameraState.EXPOSING
+    trial(solver.next())
+    return orjson.dumps(state.flat_solve).decode()
+
+def _flat_status(parameters: dict):
+    """Progress of the last FlatExposure: the trials so far as [exposure, level],
+    and when done the exposure found"""
+    return orjson.dumps(state.flat_solve or {'state': 'idle'}).decode()
+
+_actions = {
+    'CalibrationCapture': _calibration_capture,
+    'CalibrationStatus': _calibration_status,
+    'CalibrationMasters': _calibration_masters,
+    'CalibrationApply': _calibration_apply,
+    'BiasBurst': _bias_burst,
+    'HotPixelMap': _hotpixel_map,
+    'HotPixelCorrect': _hotpixel_correct,
+    'AnalyzeStars': _analyze_stars,
+    'GuideStart': _guide_start,
+    'GuideRecords': _guide_records,
+    'GuideStop': _guide_stop,
+    'PhotometryStart': _photometry_start,
+    'PhotometryRead': _photometry_read,
+    'PhotometryStop': _photometry_stop,
+    'LuckyCapture': _lucky_capture,
+    'LuckyStatus': _lucky_status,
+    'RecordStart': _record_start,
+    'RecordStatus': _record_status,
+    'RecordStop': _record_stop,
+    'AllSkyStart': _allsky_start,
+    'AllSkyStatus': _allsky_status,
+    'AllSkyStop': _allsky_stop,
+    'MeteorStart': _meteor_start,
+    'MeteorStatus': _meteor_status,
+    'MeteorStop': _meteor_stop,
+    'FlatExposure': _flat_exposure,
+    'FlatStatus': _flat_status,
+}
+
 # RESOURCE CONTROLLERS
 @before(PreProcessRequest(maxdev))
 class Action:
     def on_put(self, req: Request, resp: Response, devnum: int):
-        resp.text = MethodResponse(req, NotImplementedException()).json
+        if not picam2.started:
+            resp.text = MethodResponse(req, NotConnectedException()).json
+            return
+        name = get_request_field('Action', req)      # Raises 400 bad request if missing
+        # Action names are case insensitive
+        action = next((fn for n, fn in _actions.items() if n.lower() == name.lower()), None)
+        if action is None:
+            resp.text = MethodResponse(req, ActionNotImplementedException(f'Action {name} is not implemented')).json
+            return
+        paramstr = get_request_field('Parameters', req, default='')
+        try:
+            parameters = orjson.loads(paramstr) if paramstr.strip() else {}
+            if not isinstance(parameters, dict):
+                raise ValueError('Parameters must be a JSON object')
+        except ValueError as ex:
+            resp.text = MethodResponse(req, InvalidValueException(f'Action {name}: {ex}')).json
+            return
+        try:
+            resp.text = MethodResponse(req, value=action(parameters)).json
+        except ValueError as ex:
+            resp.text = MethodResponse(req, InvalidValueException(f'Action {name}: {ex}')).json
+        except RuntimeError as ex:
+            resp.text = MethodResponse(req, InvalidOperationException(f'Action {name}: {ex}')).json
+        except Exception as ex:
+            resp.text = MethodResponse(req,
+                            DriverException(0x500, f'Camera.Action {name} failed', ex)).json
 
 @before(PreProcessRequest(maxdev))
 class CommandBlind:
@@ -120,7 +851,7 @@ class Name():
 @before(PreProcessRequest(maxdev))
 class SupportedActions():
     def on_get(self, req: Request, resp: Response, devnum: int):
-        resp.text = PropertyResponse([], req).json  # Not PropertyNotImplemented
+        resp.text = PropertyResponse(list(_actions), req).json  # Not PropertyNotImplemented
 
 @before(PreProcessRequest(maxdev))
 class bayeroffsetx:
@@ -185,14 +916,14 @@ class binx:
             resp.text = MethodResponse(req,
                             InvalidValueException(f'BinX {binxstr} not in range')).json
             return
+        if binx != state.binning and _busy():
+            # A reconfigure would change the frame geometry under an exposure or capture loop
+            resp.text = MethodResponse(req,
+                            InvalidOperationException('Cannot change binning while capturing')).json
+            return
         try:
             # Set device mode            
-            if binx != state.binning:
-                # Binning mode has changed, switch camera resolution
-                state.binning = binx
-                picam2.stop()
-                picam2.configure(get_config())
-                picam2.start()
+            _set_binning(binx)
 
             resp.text = MethodResponse(req).json
         except Exception as ex:
@@ -224,14 +955,14 @@ class biny(binx):
             resp.text = MethodResponse(req,
                             InvalidValueException(f'BinY {binxstr} not in range')).json
             return
+        if binx != state.binning and _busy():
+            # A reconfigure would change the frame geometry under an exposure or capture loop
+            resp.text = MethodResponse(req,
+                            InvalidOperationException('Cannot change binning while capturing')).json
+            return
         try:
             # Set device mode            
-            if binx != state.binning:
-                # Binning mode has changed, switch camera resolution
-                state.binning = binx
-                picam2.stop()
-                picam2.configure(get_config())
-                picam2.start()
+            _set_binning(binx)
             resp.text = MethodResponse(req).json
         except Exception as ex:
             resp.text = MethodResponse(req,
@@ -523,6 +1254,29 @@ class heatsinktemperature:
 class imagearray:
 
     def on_get(self, req: Request, resp: Response, devnum: int):
+        with profiler.allocations('imagearray'):
+            self.get_image(req, resp)
+
+    def fetch(self, f):
+        """Raw frame and metadata from the completed exposure, releasing its request"""
+        # Get request
+        with f.span('wait'):
+            request = picam2.wait(state.job)
+
+        # Grab metadata
+        with f.span('metadata'):
+            metadata = request.get_metadata()
+
+        # Grab image data
+        with f.span('make_array'):
+            array = request.make_array('raw')
+
+        # Release the request
+        with f.span('release'):
+            request.release()
+        return array, metadata
+
+    def get_image(self, req: Request, resp: Response):
         if not picam2.started:
             resp.text = PropertyResponse(None, req,
                             NotConnectedException()).json
@@ -534,11 +1288,20 @@ class imagearray:
             return
         
         try:
-            # Get request
-            request = picam2.wait(state.job)
+            f = timing.recorder.frame('imagearray')
 
-            # Grab metadata
-            metadata = request.get_metadata()
+            if state.stacked is not None:
+                # Live stack, already cropped to the subframe, or a master
+                array, bits, metadata, origin = state.stacked
+                state.stacked = None
+                geometry = (0, 0, array.shape[1], array.shape[0])
+            else:
+                # Let the last frame go first, so there are never two held at once
+                state.last_frame = None
+                array, metadata = self.fetch(f)
+                bits = 12
+                geometry = (state.start_x, state.start_y, state.num_x, state.num_y)
+                origin = geometry[:2]
 
             # Update temperature stats
             try:
@@ -546,62 +1309,131 @@ class imagearray:
             except ValueError as e:
                 logger.error(e)
 
-            # Grab image data
-            array = request.make_array('raw')
-
             # Log the metadata
-            if logger.level == logging.DEBUG:
+            if logger.isEnabledFor(logging.DEBUG):
                 info_str = ', '.join([f'{key}={value}' for key, value in metadata.items()])
                 logger.debug((f"Metadata: {info_str}"))
 
             state.imageReady = False # We've grabbed the image now
 
-            # Release the request
-            request.release()
-
-            # Reformat the array. ChatGPT optimized this for speed
-            array = array.view(np.uint16) * np.left_shift(1, (16 - 12))
-
-            # Resize array to correct frame size according to max resolution and subframe settings
-            array = array[state.start_y:state.start_y + state.num_y, state.start_x:state.start_x + state.num_x]
-            array = np.transpose(array)
+            t0 = time.perf_counter()
+            if state.calibrate and origin is not None and bits == 12:
+                # Crop first, so only the subframe is calibrated
+                x, y, w, h = geometry
+                with f.span('calibrate'):
+                    array = calibrator().apply(array.view(np.uint16)[y:y + h, x:x + w], origin, sensor.get_name(),
+                                               state.gainvalue, state.last_duration, state.binning, state.temperature)
+                geometry = (0, 0, w, h)
+            if state.correct_hotpixels and origin is not None:
+                hp = hotpixel_map(state.binning)
+                if hp is not None:
+                    x, y, w, h = geometry
+                    with f.span('hotpixels'):
+                        hp.correct(array.view(np.uint16)[y:y + h, x:x + w], origin)
+            array = raw_to_imagearray(array, *geometry, f, bits)
+            if origin is not None:
+                # Kept for the analysis actions and preview. It's the subframe as
+                # downloaded, made anyway, so keeping it costs no more at the peak
+                state.frame_id += 1
+                state.last_frame = {'array': array.T, 'origin': origin, 'bits': 16, 'metadata': metadata,
+                                    'saturation': 0.95 * 0xfff0 if bits == 12 else None, 'id': state.frame_id}
 
             accept = req.headers.get("ACCEPT")
-            if accept is not None and 'imagebytes' in accept:
+            if accept is not None and SHUFFLE_CONTENT_TYPE in accept:
+                # Byte-shuffled & deflated ImageBytes for our own tooling. Check
+                # this first as it also contains the string 'imagebytes'
+                logger.debug("Creating shuffled ImageArrayResponse")
+                with f.span('shuffle'):
+                    pr = ImageArrayResponse(array, req)
+                    data = pr.shuffled
+                resp.content_type = SHUFFLE_CONTENT_TYPE
+                logger.debug("Created shuffled ImageArrayResponse")
+                metrics.conversion_seconds.observe(time.perf_counter() - t0)
+                _send_data(resp, data, f)
+
+            elif accept is not None and 'imagebytes' in accept:
                 # ImageBytes
 
                 # Create response
                 logger.debug("Creating ImageArrayResponse")
-                pr = ImageArrayResponse(array, req)                
-                resp.data = pr.binary
+                with f.span('pack'):
+                    pr = ImageArrayResponse(array, req)
+                    data = pr.binary
                 resp.content_type = 'application/imagebytes'
                 logger.debug("Created ImageArrayResponse")
+                metrics.conversion_seconds.observe(time.perf_counter() - t0)
+                _send_data(resp, data, f)
 
             else:
                 # JSON - warning, this is speed optimized but it still much slower than imagebytes!
 
                 # Convert array to a list of tuples, where each tuple is a column
-                array = list(map(tuple, array.astype(int).tolist()))
+                with f.span('tolist'):
+                    array = list(map(tuple, array.astype(int).tolist()))
 
                 # Create response
                 logger.debug("Creating ImageArrayResponse")
-                pr = ImageArrayResponse(array, req)
-                resp.text = pr.json 
+                with f.span('json'):
+                    pr = ImageArrayResponse(array, req)
+                    resp.text = pr.json
                 resp.content_type = 'application/json'
                 logger.debug("Created ImageArrayJsonResponse")
+                metrics.conversion_seconds.observe(time.perf_counter() - t0)
+                timing.recorder.commit(f)
         except Exception as ex:
             resp.text = PropertyResponse(None, req,
                             DriverException(0x500, 'Camera.Imagearray failed', ex)).json
 
+# Convert a raw 12 bit frame (as bytes) to the 16 bit, subframed, transposed ImageArray.
+# Stacked frames are already cropped, and a sum already has 16 significant bits
+def raw_to_imagearray(array: np.ndarray, start_x: int, start_y: int, num_x: int, num_y: int, f, bits: int = 12):
+    # Resize array to correct frame size according to max resolution and subframe settings.
+    # Crop first, as it's only a view, so the shift copies just the subframe
+    with f.span('crop'):
+        array = array.view(np.uint16)[start_y:start_y + num_y, start_x:start_x + num_x]
+
+    # Reformat the array. Shift rather than multiply, which NumPy 2 would promote to int64
+    if bits < 16:
+        with f.span('shift'):
+            array = array << (16 - bits)
+    with f.span('transpose'):
+        array = np.transpose(array)
+    return array
+
+# When timing, hand the WSGI server a generator so we can time the socket writes too
+def _send_data(resp: Response, data: bytes, f):
+    if timing.recorder.enabled:
+        resp.content_length = len(data)
+        resp.stream = timing.recorder.stream(f, data)
+    else:
+        resp.data = data
+
 @before(PreProcessRequest(maxdev))
 class imagearrayvariant(imagearray):
     def on_get(self, req: Request, resp: Response, devnum: int):
         super().on_get(req, resp, devnum)
 
+def onstackfinished(loop: capture.FrameLoop, stacker: capture.Stacker):
+    f = timing.recorder.frame('onstackfinished')
+    f.record('exposure', time.perf_counter() - state.exposure_started)
+    if loop.error is None:
+        with f.span('result'):
+            array, bits = stacker.result()
+        state.stacked = (array, bits, stacker.metadata, stacker.origin)
+        state.imageReady = True
+        logger.info(f'Stacked {stacker.count} frames')
+    state.camerastate = CameraState.IDLE if loop.error is None else CameraState.ERROR
+    metrics.frames_captured.inc(loop.frames)
+    timing.recorder.commit(f)
+
 def oncapturefinished(Job):
+    f = timing.recorder.frame('oncapturefinished')
+    f.record('exposure', time.perf_counter() - state.exposure_started)
     state.camerastate = CameraState.IDLE
     state.imageReady = True
+    metrics.frames_captured.inc()
     logger.debug("oncapturefinished")
+    timing.recorder.commit(f)
 
 @before(PreProcessRequest(maxdev))
 class imageready:
@@ -799,6 +1631,53 @@ class pixelsizey(pixelsizex):
     def on_get(self, req: Request, resp: Response, devnum: int):
         super().on_get(req, resp, devnum)
 
+# Not part of the Alpaca API: a small stretched colour image of the last frame,
+# for a quick look at focus and framing without downloading the ImageArray
+@before(PreProcessRequest(maxdev))
+class preview:
+
+    def on_get(self, req: Request, resp: Response, devnum: int):
+        if not picam2.started:
+            resp.text = PropertyResponse(None, req,
+                            NotConnectedException()).json
+            return
+        sizestr = get_request_field('Size', req, default='512')
+        form = get_request_field('Format', req, default='png').lower()
+        try:
+            size = int(sizestr)
+        except:
+            resp.text = PropertyResponse(None, req,
+                            InvalidValueException(f'Size {sizestr} not a valid number.')).json
+            return
+        if size < 16 or size > 2048 or form not in ('png', 'jpeg', 'jpg'):
+            resp.text = PropertyResponse(None, req,
+                            InvalidValueException('Size must be 16 to 2048 and Format png or jpeg.')).json
+            return
+        frame = state.last_frame
+        if frame is None:
+            resp.text = PropertyResponse(None, req,
+                            InvalidOperationException('No frame has been captured')).json
+            return
+        try:
+            # Rendered once per frame, however many times it's asked for
+            key = (frame['id'], size, form)
+            if state.preview is None or state.preview[:3] != key:
+                bayer = sensor.get_bayer_pattern()
+                x, y = frame['origin']
+                image = render.preview(frame['array'], (bayer.get_offset_x() + x) % 2,
+                                       (bayer.get_offset_y() + y) % 2, size, frame['bits'])
+                data = render.jpeg(image) if form != 'png' else None
+                if data is not None:
+                    state.preview = key + ('image/jpeg', data)
+                else:
+                    # Without Pillow, PNG it is
+                    state.preview = key + ('image/png', render.png(image, 1))
+            resp.content_type = state.preview[3]
+            resp.data = state.preview[4]
+        except Exception as ex:
+            resp.text = PropertyResponse(None, req,
+                            DriverException(0x500, 'Camera.Preview failed', ex)).json
+
 @before(PreProcessRequest(maxdev))
 class readoutmode:
 
@@ -950,31 +1829,46 @@ class starty:
 class subexposureduration:
 
     def on_get(self, req: Request, resp: Response, devnum: int):
-        resp.text = PropertyResponse(None, req,
-                NotImplementedException()).json    
+        if not picam2.started:
+            resp.text = PropertyResponse(None, req,
+                            NotConnectedException()).json
+            return
+        resp.text = PropertyResponse(state.subexposure_duration, req).json
 
     def on_put(self, req: Request, resp: Response, devnum: int):
-        resp.text = PropertyResponse(None, req,
-                NotImplementedException()).json
+        if not picam2.started:
+            resp.text = PropertyResponse(None, req,
+                            NotConnectedException()).json
+            return
+        durationstr = get_request_field('SubExposureDuration', req)      # Raises 400 bad request if missing
+        try:
+            duration = float(durationstr)
+        except:
+            resp.text = MethodResponse(req,
+                            InvalidValueException(f'SubExposureDuration {durationstr} not a valid number.')).json
+            return
+
+        ### RANGE CHECK. 0 turns stacking off
+        if duration < 0 or duration > 600:
+            resp.text = MethodResponse(req,
+                            InvalidValueException(f'SubExposureDuration {durationstr} is out of bounds')).json
+            return
+
+        state.subexposure_duration = duration
+        resp.text = MethodResponse(req).json
 
 @before(PreProcessRequest(maxdev))
 class abortexposure:
 
     def on_put(self, req: Request, resp: Response, devnum: int):
-        global picam2
         if not picam2.started:
             resp.text = PropertyResponse(None, req,
                             NotConnectedException()).json
             return
         try:
             if state.camerastate == CameraState.EXPOSING:
-                picam2.stop_()
-                picam2.stop()
-                picam2.close()
-                picam2 = Picamera2()
-                picam2.configure(get_config())
-                picam2.start()
-                state.camerastate = CameraState.IDLE
+                _reset_camera()
+                metrics.pipeline_restart('abort')
             resp.text = MethodResponse(req).json
         except Exception as ex:
             resp.text = MethodResponse(req,
@@ -1014,26 +1908,46 @@ class startexposure:
                             InvalidValueException(f'Duration {durationstr} is out of bounds')).json
             return
 
+        if state.frame_loop is not None and state.frame_loop.is_alive():
+            resp.text = MethodResponse(req, InvalidOperationException()).json
+            return
+
+        # Live stacking, when the subexposure is shorter than the exposure
+        subexposure = state.subexposure_duration
+        stacking = 0 < subexposure < duration
+        if stacking:
+            duration, count = subexposure, max(int(round(duration / subexposure)), 1)
+
         if duration != state.last_duration:
             state.last_duration = duration
             state.need_restart = True
 
         try:
             logger.debug("Exposure duration is %f, gain is %d", duration, state.gainvalue)
+            f = timing.recorder.frame('startexposure')
 
             if state.need_restart:
-                picam2.stop()
-                with picam2.controls as controls:
-                    controls.ExposureTime = int(duration * 1e6)
-                    controls.AeEnable = False
-                    controls.NoiseReductionMode = libcamera.controls.draft.NoiseReductionModeEnum.Off
-                    controls.AwbEnable = False
-                    controls.AnalogueGain = state.gainvalue
-                picam2.start()
+                with f.span('restart'):
+                    _apply_controls(duration)
                 state.need_restart = False
-
-            state.job = picam2.capture_request(signal_function=oncapturefinished)
+                metrics.pipeline_restart('settings')
+
+            state.exposure_started = time.perf_counter()
+            state.stacked = None
+            if stacking:
+                logger.info(f'Stacking {count} x {duration}s')
+                state.imageReady = False
+                state.camerastate = CameraState.EXPOSING
+                stacker = capture.Stacker(state.start_x, state.start_y, state.num_x, state.num_y, Config.stack_mode)
+                with f.span('capture_request'):
+                    state.frame_loop = capture.FrameLoop(picam2, stacker.add, count,
+                                                         lambda loop: onstackfinished(loop, stacker), 'Stacker')
+                    state.frame_loop.start()
+            else:
+                with f.span('capture_request'):
+                    state.job = picam2.capture_request(signal_function=oncapturefinished)
             state.camerastate = CameraState.EXPOSING
+            timing.recorder.commit(f)
             # -----------------------------
             resp.text = MethodResponse(req).json
         except Exception as ex:
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# capture.py - Back to back frame capture, and on-device stacking
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# A FrameLoop captures frames one after another on its own thread and hands
+# each one to a consumer. The next capture is queued before the consumer is
+# called, so the consumer works while the sensor exposes the next frame, and
+# only has to keep up with the frame rate rather than add to it. An
+# IntervalLoop does the same on a schedule, one frame at a time. Frames are
+# cropped to the configured raw size, dropping any stride padding, so every
+# consumer sees the sensor's width.
+#
+# Kept out of camera.py, where every class becomes an Alpaca route.
+
+import threading
+import time
+import numpy as np
+from logging import Logger
+import timing
+
+logger: Logger = None
+
+class FrameLoop(threading.Thread):
+    """Capture ``count`` frames (or until stopped, if None) and pass each to
+    ``consumer(array, metadata, index)``. ``array`` is the raw frame as uint16,
+    at the raw size the camera is configured for (binning can't change while
+    a loop runs). ``on_done(loop)`` is called at the end unless the loop was stopped."""
+
+    def __init__(self, camera, consumer, count: int = None, on_done=None, name: str = 'FrameLoop'):
+        super().__init__(name=name, daemon=True)
+        self.camera = camera
+        self.consumer = consumer
+        self.count = count
+        self.on_done = on_done
+        self.frames = 0
+        self.error = None
+        self.width, self.height = camera.camera_config['raw']['size']
+        self._halt = threading.Event()
+
+    def stop(self, wait: bool = True):
+        self._halt.set()
+        if wait and threading.current_thread() is not self:
+            self.join()
+
+    @property
+    def stopped(self) -> bool:
+        return self._halt.is_set()
+
+    def _capture(self):
+        """Queue a capture. Returns the job and an event set when it completes"""
+        done = threading.Event()
+        job = self.camera.capture_request(wait=False, signal_function=lambda job: done.set())
+        return job, done
+
+    def _read(self, job):
+        """The raw frame and metadata of a completed job, releasing its request"""
+        request = self.camera.wait(job)
+        metadata = request.get_metadata()
+        array = request.make_array('raw').view(np.uint16)[:self.height, :self.width]     # Drop any stride padding
+        request.release()
+        return array, metadata
+
+    def run(self):
+        try:
+            job, done = self._capture()
+            while not self._halt.is_set():
+                # Poll so that stop() works even if the camera never completes the job
+                if not done.wait(0.1):
+                    continue
+                array, metadata = self._read(job)
+                index = self.frames
+                self.frames += 1
+                last = self.count is not None and self.frames >= self.count
+                if not last:
+                    job, done = self._capture()
+                self.consumer(array, metadata, index)
+                if last:
+                    if self.on_done is not None:
+                        self.on_done(self)
+                    return
+        except Exception as ex:
+            self.error = ex
+            logger.error(f'{self.name} failed: {ex}')
+            if self.on_done is not None and not self._halt.is_set():
+                self.on_done(self)
+
+class IntervalLoop(FrameLoop):
+    """Capture a frame every ``interval`` seconds until stopped, passing each
+    to ``consumer`` as a FrameLoop does. ``before(loop)`` is called before each
+    capture, so it can change the controls."""
+
+    def __init__(self, camera, consumer, interval: float, before=None, on_done=None, name: str = 'IntervalLoop'):
+        super().__init__(camera, consumer, None, on_done, name)
+        self.interval = interval
+        self.before = before
+
+    def run(self):
+        try:
+            due = time.monotonic()
+            while not self._halt.is_set():
+                if self.before is not None:
+                    self.before(self)
+                job, done = self._capture()
+                while not done.wait(0.1):
+                    if self._halt.is_set():
+                        return
+                array, metadata = self._read(job)
+                index = self.frames
+                self.frames += 1
+                self.consumer(array, metadata, index)
+                # On schedule, unless a frame took longer than the interval
+                due = max(due + self.interval, time.monotonic())
+                self._halt.wait(due - time.monotonic())
+        except Exception as ex:
+            self.error = ex
+            logger.error(f'{self.name} failed: {ex}')
+            if self.on_done is not None and not self._halt.is_set():
+                self.on_done(self)
+
+class Stacker:
+    """Adds raw frames, cropped to the subframe, into a uint32 accumulator.
+
+    ``result()`` gives the mean, as 12 bit data like a single frame, or the
+    sum, clipped to 16 bits.
+    """
+    def __init__(self, start_x: int, start_y: int, num_x: int, num_y: int, mode: str = 'mean'):
+        if mode not in ('mean', 'sum'):
+            raise ValueError(f'Unknown stacking mode {mode}')
+        self.crop = (slice(start_y, start_y + num_y), slice(start_x, start_x + num_x))
+        self.origin = (start_x, start_y)
+        self.mode = mode
+        self.count = 0
+        self.metadata = None
+        self._sum = None
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        f = timing.recorder.frame('stack')
+        with f.span('accumulate'):
+            frame = array[self.crop]
+            if self._sum is None:
+                self._sum = frame.astype(np.uint32)
+            else:
+                np.add(self._sum, frame, out=self._sum)     # In place, no temporaries
+        self.count += 1
+        self.metadata = metadata
+        timing.recorder.commit(f)
+
+    def result(self):
+        """Returns (uint16 array, significant bits)"""
+        if self.mode == 'sum':
+            return np.minimum(self._sum, 0xFFFF).astype(np.uint16), 16
+        # Rounded mean
+        self._sum += self.count // 2
+        self._sum //= self.count
+        return self._sum.astype(np.uint16), 12
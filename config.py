@@ -73,6 +73,91 @@ class Config:
     can_reverse: bool = get_toml('device', 'can_reverse')
     step_size: float = get_toml('device', 'step_size')
     steps_per_sec: int = get_toml('device', 'steps_per_sec')
+    # --------------
+    # Camera Section
+    # --------------
+    camera_backend: str = get_toml('camera', 'backend')
+    # ----------------
+    # Stacking Section
+    # ----------------
+    stack_mode: str = get_toml('stacking', 'mode')
+    # -------------------
+    # Calibration Section
+    # -------------------
+    calibration_library: str = get_toml('calibration', 'library')
+    calibration_frames: int = get_toml('calibration', 'frames')
+    calibration_method: str = get_toml('calibration', 'method')
+    calibration_sigma: float = get_toml('calibration', 'sigma')
+    calibration_band_mb: int = get_toml('calibration', 'band_mb')
+    calibration_apply: bool = get_toml('calibration', 'apply')
+    calibration_pedestal: float = get_toml('calibration', 'pedestal')
+    calibration_cache: int = get_toml('calibration', 'cache')
+    # -----------------
+    # Hot Pixel Section
+    # -----------------
+    hotpixel_correct: bool = get_toml('hotpixels', 'correct')
+    hotpixel_sigma: float = get_toml('hotpixels', 'sigma')
+    hotpixel_min_excess: float = get_toml('hotpixels', 'min_excess')
+    # ---------------
+    # Guiding Section
+    # ---------------
+    guide_box: int = get_toml('guiding', 'box')
+    guide_history: int = get_toml('guiding', 'history')
+    # ------------------
+    # Photometry Section
+    # ------------------
+    photometry_radius: float = get_toml('photometry', 'radius')
+    photometry_inner: float = get_toml('photometry', 'inner')
+    photometry_outer: float = get_toml('photometry', 'outer')
+    photometry_history: int = get_toml('photometry', 'history')
+    # -------------
+    # Lucky Section
+    # -------------
+    lucky_count: int = get_toml('lucky', 'count')
+    lucky_keep: int = get_toml('lucky', 'keep')
+    lucky_max_mb: int = get_toml('lucky', 'max_mb')
+    # --------------
+    # AllSky Section
+    # --------------
+    allsky_directory: str = get_toml('allsky', 'directory')
+    allsky_interval: float = get_toml('allsky', 'interval')
+    allsky_size: int = get_toml('allsky', 'size')
+    allsky_target: float = get_toml('allsky', 'target')
+    allsky_black: float = get_toml('allsky', 'black')
+    allsky_max_exposure: float = get_toml('allsky', 'max_exposure')
+    allsky_night_exposure: float = get_toml('allsky', 'night_exposure')
+    # --------------
+    # Meteor Section
+    # --------------
+    meteor_directory: str = get_toml('meteors', 'directory')
+    meteor_binning: int = get_toml('meteors', 'binning')
+    meteor_threshold: float = get_toml('meteors', 'threshold')
+    meteor_min_pixels: int = get_toml('meteors', 'min_pixels')
+    meteor_pre: int = get_toml('meteors', 'pre')
+    meteor_post: int = get_toml('meteors', 'post')
+    meteor_max_clip: int = get_toml('meteors', 'max_clip')
+    # -----------------
+    # Recording Section
+    # -----------------
+    recording_directory: str = get_toml('recording', 'directory')
+    recording_buffers: int = get_toml('recording', 'buffers')
+    recording_observer: str = get_toml('recording', 'observer')
+    recording_telescope: str = get_toml('recording', 'telescope')
+    # -----------------
+    # Simulator Section
+    # -----------------
+    simulator_model: str = get_toml('simulator', 'model')
+    simulator_scene: str = get_toml('simulator', 'scene')
+    simulator_seed: int = get_toml('simulator', 'seed')
+    simulator_time_scale: float = get_toml('simulator', 'time_scale')
+    simulator_temperature: float = get_toml('simulator', 'temperature')
+    # -------------------
+    # Diagnostics Section
+    # -------------------
+    timing_enabled: bool = get_toml('diagnostics', 'timing')
+    timing_history: int = get_toml('diagnostics', 'timing_history')
+    record_traffic: bool = get_toml('diagnostics', 'record_traffic')
+    record_file: str = get_toml('diagnostics', 'record_file')
     # ---------------
     # Logging Section
     # ---------------
@@ -80,3 +165,4 @@ class Config:
     log_to_stdout: str = get_toml('logging', 'log_to_stdout')
     max_size_mb: int = get_toml('logging', 'max_size_mb')
     num_keep_logs: int = get_toml('logging', 'num_keep_logs')
+    log_queue_size: int = get_toml('logging', 'queue_size')
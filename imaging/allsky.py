@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# allsky.py - All-sky camera: auto exposure, preview, keogram and star trails
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# An AllSky is the consumer of a capture.IntervalLoop. Each frame becomes a
+# stretched colour preview (see render.py), written as latest.png, and then:
+#
+#   * its middle column is appended to the night's keogram
+#   * if it's a night frame, it's added to the star trails by np.maximum
+#
+# so neither ever goes back over earlier frames. The next exposure is scaled
+# from this frame's median level, above the black level, towards the target.
+# A night runs from noon to noon; at the change the keogram and star trails
+# are written as PNGs, named by the date the night started, and begun again.
+
+import os
+import time
+import numpy as np
+from logging import Logger
+from imaging import render
+
+logger: Logger = None
+
+MAX_STEP = 4                            # Most the exposure may change by from one frame to the next
+
+def night_of(t: float) -> str:
+    """The date the night containing Unix time ``t`` started, as YYYYMMDD"""
+    return time.strftime('%Y%m%d', time.localtime(t - 12 * 3600))
+
+class AllSky:
+    def __init__(self, directory: str, offset_x: int, offset_y: int, exposure: float, min_exposure: float,
+                 max_exposure: float, target: float = 0.25, black: float = 256, night_exposure: float = 1.0,
+                 size: int = 512, max_adu: int = 4095):
+        self.directory = directory
+        self.offsets = (offset_x, offset_y)
+        self.exposure = exposure        # For the next frame
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.target = target * max_adu  # Median level aimed for
+        self.black = black
+        self.night_exposure = night_exposure
+        self.size = size
+        self.max_adu = max_adu
+        self.frames = 0
+        self.last = None                # Summary of the last frame
+        self.night = None
+        self._keogram = []              # One (height, 3) column per frame
+        self._trails = None
+        self._trail_frames = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        now = time.time()
+        night = night_of(now)
+        if night != self.night:
+            self.save()
+            self.night = night
+            self._keogram, self._trails, self._trail_frames = [], None, 0
+        exposure = metadata.get('ExposureTime', self.exposure * 1e6) / 1e6
+        image = render.preview(array, *self.offsets, self.size)
+        self._write('latest.png', render.png(image))
+        self._keogram.append(image[:, image.shape[1] // 2].copy())
+        if exposure >= self.night_exposure:
+            if self._trails is None or self._trails.shape != image.shape:
+                self._trails = image.copy()
+            else:
+                np.maximum(self._trails, image, out=self._trails)
+            self._trail_frames += 1
+        # Auto exposure from a sparse sample, which is plenty for a median
+        level = float(np.median(array[::8, ::8]))
+        scale = (self.target - self.black) / max(level - self.black, 1.0)
+        self.exposure = float(np.clip(exposure * np.clip(scale, 1 / MAX_STEP, MAX_STEP),
+                                      self.min_exposure, self.max_exposure))
+        self.frames += 1
+        self.last = {'time': now, 'exposure': exposure, 'level': level, 'next_exposure': round(self.exposure, 6)}
+
+    def keogram(self) -> np.ndarray:
+        """(height, frames, 3) uint8 image of the night so far"""
+        return np.stack(self._keogram, axis=1) if self._keogram else None
+
+    def save(self):
+        """Write the night's keogram and star trails so far"""
+        if self.night is None:
+            return
+        keogram = self.keogram()
+        if keogram is not None:
+            self._write(f'keogram-{self.night}.png', render.png(keogram))
+        if self._trails is not None:
+            self._write(f'startrails-{self.night}.png', render.png(self._trails))
+
+    def _write(self, name: str, data: bytes):
+        # Replace whole, so a web server never serves half a file
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def status(self) -> dict:
+        return {
+            'night': self.night,
+            'frames': self.frames,
+            'keogram': len(self._keogram),
+            'trails': self._trail_frames,
+            'last': self.last,
+            'exposure': round(self.exposure, 6),
+        }
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# calibration.py - Master bias, dark and flat frames, built on the Pi
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# A Combiner takes the frames as they are captured and writes them to an
+# np.memmap scratch file, so 50 full frames don't have to fit in memory. Once
+# they're all in, it combines them a band of rows at a time, with a sigma
+# clipped mean or a median, keeping the working memory to a fixed budget.
+# A StreamCombiner instead combines as the frames arrive, with no scratch file,
+# so it keeps up with bias frames at the full frame rate.
+#
+# Masters go into a Library: a directory of .npy files, in raw 12 bit units
+# at the binned sensor resolution, with an index.json saying what each was
+# taken with (sensor, gain, exposure, binning and temperature). A Calibrator
+# applies the nearest of them to each frame as it is read out.
+
+import os
+import json
+import time
+import numpy as np
+from collections import OrderedDict
+from logging import Logger
+
+logger: Logger = None
+
+KINDS = ('bias', 'dark', 'flat')
+
+class Master:
+    """A stored master frame and the settings it was taken with"""
+    def __init__(self, kind: str, sensor: str, gain: int, exposure: float, binning: int,
+                 temperature: float, frames: int, file: str = None, created: float = None):
+        self.kind = kind
+        self.sensor = sensor
+        self.gain = gain
+        self.exposure = exposure
+        self.binning = binning
+        self.temperature = temperature
+        self.frames = frames
+        self.file = file or f'{kind}-{sensor}-g{gain}-e{exposure:g}-b{binning}-t{round(temperature)}.npy'
+        self.created = created or time.time()
+
+    @property
+    def key(self) -> tuple:
+        return (self.kind, self.sensor, self.gain, self.exposure, self.binning, round(self.temperature))
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+class Library:
+    """Master frames in a directory, indexed by index.json. A new master
+    replaces any with the same settings (temperature to the nearest degree)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._index = os.path.join(path, 'index.json')
+        self._masters = []
+        if os.path.exists(self._index):
+            with open(self._index) as f:
+                self._masters = [Master(**m) for m in json.load(f)]
+
+    def masters(self, kind: str = None) -> list:
+        return [m for m in self._masters if kind is None or m.kind == kind]
+
+    def add(self, master: Master, array: np.ndarray) -> Master:
+        np.save(os.path.join(self.path, master.file), array.astype(np.float32, copy=False))
+        self._masters = [m for m in self._masters if m.key != master.key] + [master]
+        self._save()
+        logger.info(f'Saved master {master.file}')
+        return master
+
+    def load(self, master: Master) -> np.ndarray:
+        """The master's data, memory mapped, so only what's used is read"""
+        return np.load(os.path.join(self.path, master.file), mmap_mode='r')
+
+    def _save(self):
+        tmp = self._index + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump([m.as_dict() for m in self._masters], f, indent=1)
+        os.replace(tmp, self._index)            # Never leave a half written index
+
+class _Combine:
+    """What the combiners share: up to ``count`` frames of ``shape``, combined
+    by one of the class's METHODS, and the sensor temperatures they were taken at"""
+    METHODS = ()
+
+    def __init__(self, count: int, shape: tuple, method: str):
+        if method not in self.METHODS:
+            raise ValueError(f'Unknown combine method {method}')
+        self.count = count
+        self.shape = shape
+        self.method = method
+        self.frames = 0
+        self.temperatures = []
+
+    def _added(self, metadata: dict):
+        self.frames += 1
+        if 'SensorTemperature' in metadata:
+            self.temperatures.append(float(metadata['SensorTemperature']))
+
+    @property
+    def temperature(self) -> float:
+        return float(np.mean(self.temperatures)) if self.temperatures else 0.0
+
+    def close(self):
+        pass
+
+class Combiner(_Combine):
+    """Collects up to ``count`` frames of ``shape`` in a scratch file, then
+    combines them. Use ``add`` as a capture.FrameLoop consumer."""
+    METHODS = ('sigma', 'median', 'mean')
+
+    def __init__(self, count: int, shape: tuple, scratch_dir: str, method: str = 'sigma',
+                 sigma: float = 3.0, band_bytes: int = 64 * 1024 * 1024):
+        super().__init__(count, shape, method)
+        self.sigma = sigma
+        self.band_bytes = band_bytes
+        os.makedirs(scratch_dir, exist_ok=True)
+        self._file = os.path.join(scratch_dir, f'scratch-{os.getpid()}-{id(self)}.u16')
+        self._scratch = np.memmap(self._file, dtype=np.uint16, mode='w+', shape=(count,) + tuple(shape))
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        if self.frames >= self.count:
+            return
+        self._scratch[self.frames] = array[:self.shape[0], :self.shape[1]]     # Drop any stride padding
+        self._added(metadata)
+
+    def combine(self) -> np.ndarray:
+        """The combined frame as float32, in the same units as the frames"""
+        if self.frames == 0:
+            raise ValueError('No frames to combine')
+        height, width = self.shape
+        data = self._scratch[:self.frames]
+        # Rows per band, allowing for the float32 copy and the temporaries of clipping
+        rows = max(1, min(height, self.band_bytes // (self.frames * width * 4 * 3)))
+        result = np.empty(self.shape, dtype=np.float32)
+        for top in range(0, height, rows):
+            band = data[:, top:top + rows]
+            if self.method == 'median':
+                result[top:top + rows] = np.median(band, axis=0)
+            elif self.method == 'mean':
+                result[top:top + rows] = band.mean(axis=0, dtype=np.float32)
+            else:
+                result[top:top + rows] = self._sigma_clipped_mean(band.astype(np.float32))
+        return result
+
+    def _sigma_clipped_mean(self, band: np.ndarray, iterations: int = 3) -> np.ndarray:
+        # Outliers (cosmic rays, satellites) become NaN and drop out of the next round
+        for _ in range(iterations):
+            mean = np.nanmean(band, axis=0)
+            std = np.nanstd(band, axis=0)
+            outliers = np.abs(band - mean) > self.sigma * std
+            if not outliers.any():
+                break
+            band[outliers] = np.nan
+        return np.nanmean(band, axis=0)
+
+    def close(self):
+        """Remove the scratch file"""
+        if self._scratch is not None:
+            self._scratch = None                # Unmaps it once nothing else refers to it
+            os.remove(self._file)
+
+class StreamCombiner(_Combine):
+    """Combines frames as they're added, into a mean with each pixel's highest
+    and lowest values left out, which drops a cosmic ray or hot readout just as
+    well for bias frames. Works in uint32/uint16 in place, a few ms per frame,
+    and needs no scratch file. Otherwise used as a Combiner."""
+    METHODS = ('minmax',)
+
+    def __init__(self, count: int, shape: tuple, method: str = 'minmax'):
+        super().__init__(count, shape, method)
+        self._sum = np.zeros(shape, dtype=np.uint32)
+        self._min = np.full(shape, 0xFFFF, dtype=np.uint16)
+        self._max = np.zeros(shape, dtype=np.uint16)
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        if self.frames >= self.count:
+            return
+        frame = array[:self.shape[0], :self.shape[1]]
+        np.add(self._sum, frame, out=self._sum)
+        np.minimum(self._min, frame, out=self._min)
+        np.maximum(self._max, frame, out=self._max)
+        self._added(metadata)
+
+    def combine(self) -> np.ndarray:
+        if self.frames == 0:
+            raise ValueError('No frames to combine')
+        if self.frames < 3:
+            return (self._sum / np.float32(self.frames)).astype(np.float32)
+        result = self._sum.astype(np.float32)
+        result -= self._min
+        result -= self._max
+        result /= self.frames - 2
+        return result
+
+def combiner(count: int, shape: tuple, scratch_dir: str, method: str = 'sigma',
+             sigma: float = 3.0, band_bytes: int = 64 * 1024 * 1024):
+    """A StreamCombiner for minmax, otherwise a Combiner"""
+    if method in StreamCombiner.METHODS:
+        return StreamCombiner(count, shape, method)
+    return Combiner(count, shape, scratch_dir, method, sigma, band_bytes)
+
+# A replacement master keeps the file name, so cache by the creation time too
+def _id(master: Master):
+    return None if master is None else (master.file, master.created)
+
+class Calibrator:
+    """Calibrates frames as they are read out, with the nearest masters from a
+    Library. Per frame it's one subtract and one multiply: the bias and the
+    dark, scaled to the exposure, are folded into a single offset, and the
+    flat, less bias and normalised to its mean, into a reciprocal. Both are
+    cropped to the subframe and kept in a small LRU cache."""
+
+    def __init__(self, library: Library, cache_size: int = 4, pedestal: float = 0.0, raw_max: int = 4095):
+        self.library = library
+        self.cache_size = cache_size
+        self.pedestal = pedestal                # Added back so noise below the bias isn't clipped
+        self.raw_max = raw_max                  # Of the raw data, not MaxADU, which it's shifted up to
+        self._cache = OrderedDict()
+        self.selected = {}                      # Kind -> file of the masters last used
+
+    def nearest(self, kind: str, sensor: str, gain: int, exposure: float, binning: int, temperature: float) -> Master:
+        """Closest gain first, then (for darks) exposure, then temperature, then the newest"""
+        candidates = [m for m in self.library.masters(kind) if m.sensor == sensor and m.binning == binning]
+        if not candidates:
+            return None
+        def distance(m):
+            exposure_ratio = abs(np.log(m.exposure / exposure)) if kind == 'dark' and exposure > 0 else 0
+            return (abs(m.gain - gain), exposure_ratio, abs(m.temperature - temperature), -m.created)
+        return min(candidates, key=distance)
+
+    def _cached(self, key: tuple, make):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = make()
+        self._cache[key] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def _crop(self, master: Master, crop: tuple) -> np.ndarray:
+        return np.array(self.library.load(master)[crop], dtype=np.float32)
+
+    def _offset(self, bias: Master, dark: Master, exposure: float, crop: tuple) -> np.ndarray:
+        def make():
+            offset = np.zeros((crop[0].stop - crop[0].start, crop[1].stop - crop[1].start), dtype=np.float32) \
+                if bias is None else self._crop(bias, crop)
+            if dark is not None:
+                if bias is None:
+                    offset = self._crop(dark, crop)         # Can't separate out the bias, so no scaling
+                else:
+                    thermal = self._crop(dark, crop)
+                    thermal -= offset
+                    thermal *= exposure / dark.exposure
+                    offset += thermal
+            offset -= self.pedestal
+            return offset
+        key = ('offset', _id(bias), _id(dark), exposure, crop[0].start, crop[0].stop, crop[1].start, crop[1].stop)
+        return self._cached(key, make)
+
+    def _gain(self, bias: Master, flat: Master, crop: tuple) -> np.ndarray:
+        def make():
+            # Normalise over the whole flat, so every subframe gets the same scale
+            level = float(self.library.load(flat).mean()) - (float(self.library.load(bias).mean()) if bias else 0)
+            response = self._crop(flat, crop)
+            if bias is not None:
+                response -= self._crop(bias, crop)
+            np.maximum(response, 1.0, out=response)  # Dead pixels shouldn't blow up
+            return level / response
+        key = ('gain', _id(bias), _id(flat), crop[0].start, crop[0].stop, crop[1].start, crop[1].stop)
+        return self._cached(key, make)
+
+    def apply(self, array: np.ndarray, origin: tuple, sensor: str, gain: int, exposure: float,
+              binning: int, temperature: float) -> np.ndarray:
+        """Calibrate a raw uint16 subframe whose top left is at ``origin`` (x, y)
+        in the binned sensor frame. Returns it unchanged if there are no masters."""
+        bias, dark, flat = (self.nearest(kind, sensor, gain, exposure, binning, temperature) for kind in KINDS)
+        self.selected = {k: m.file for k, m in zip(KINDS, (bias, dark, flat)) if m is not None}
+        if bias is None and dark is None and flat is None:
+            return array
+        crop = (slice(origin[1], origin[1] + array.shape[0]), slice(origin[0], origin[0] + array.shape[1]))
+        result = array.astype(np.float32)
+        if bias is not None or dark is not None:
+            result -= self._offset(bias, dark, exposure, crop)
+        if flat is not None:
+            result *= self._gain(bias, flat, crop)
+        np.clip(result, 0, self.raw_max, out=result)
+        return np.rint(result, out=result).astype(np.uint16)
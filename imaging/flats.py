@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# flats.py - Finding the exposure for flat frames
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# The mean level of a flat is very nearly offset + rate x exposure, so after
+# a first guess scaled from one trial, the secant through the last two trials
+# lands on the target in a step or two. Saturated trials say nothing about the
+# rate, only that the exposure was too long, so once one is seen the search
+# bisects (in log exposure) until it has an unsaturated trial on each side.
+
+import numpy as np
+
+MAX_STEP = 16                           # Most a trial may scale the exposure by
+
+def level(array: np.ndarray, region: float = 0.5) -> float:
+    """Mean of the central ``region`` (fraction of the width and height) of a raw frame"""
+    height, width = array.shape
+    h = max(2, int(height * region) // 2 * 2)
+    w = max(2, int(width * region) // 2 * 2)
+    y, x = (height - h) // 4 * 2, (width - w) // 4 * 2      # Even, so each colour is counted equally
+    return float(array[y:y + h, x:x + w].mean())
+
+class ExposureSolver:
+    """Proposes trial exposures until one gives a mean level within
+    ``tolerance`` (a fraction) of ``target`` ADU. Call ``next()`` for the
+    exposure to try, then ``add()`` with the exposure used and the level."""
+
+    def __init__(self, target: float, tolerance: float, min_exposure: float, max_exposure: float,
+                 max_adu: int, start: float = None, max_trials: int = 10, saturation: float = 0.95):
+        if not 0 < target < max_adu * saturation:
+            raise ValueError(f'Target must be between 0 and {max_adu * saturation:.0f} ADU')
+        self.target = target
+        self.tolerance = tolerance
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.saturated = max_adu * saturation
+        self.start = min(max(start or 1.0, min_exposure), max_exposure)
+        self.max_trials = max_trials
+        self.trials = []                # (exposure, level)
+        self.exposure = None            # The solution, once found
+        self.error = None               # Why there's no solution, once given up
+
+    @property
+    def finished(self) -> bool:
+        return self.exposure is not None or self.error is not None
+
+    def add(self, exposure: float, level: float):
+        self.trials.append((exposure, level))
+        if abs(level - self.target) <= self.tolerance * self.target:
+            self.exposure = exposure
+        elif len(self.trials) >= self.max_trials:
+            self.error = f'No exposure within tolerance after {len(self.trials)} trials'
+
+    def next(self) -> float:
+        """The next exposure to try, or None when finished"""
+        if self.finished:
+            return None
+        if not self.trials:
+            return self.start
+        exposure = self._propose()
+        exposure = min(max(exposure, self.min_exposure), self.max_exposure)
+        last, level = self.trials[-1]
+        if exposure == last:
+            if exposure == self.min_exposure and level > self.target:
+                self.error = 'Too bright at the shortest exposure'
+            elif exposure == self.max_exposure and level < self.target:
+                self.error = 'Too dark at the longest exposure'
+            else:
+                self.error = 'Not converging'
+            return None
+        return exposure
+
+    def _propose(self) -> float:
+        good = [(t, l) for t, l in self.trials if l < self.saturated]
+        saturated = [t for t, l in self.trials if l >= self.saturated]
+        if not good:
+            return min(saturated) / MAX_STEP ** 0.5
+        t, l = good[-1]
+        # One good trial: assume the level is proportional to the exposure
+        exposure = t * min(max(self.target / max(l, 1e-3), 1 / MAX_STEP), MAX_STEP)
+        if len(good) >= 2:
+            t0, l0 = good[-2]
+            if t != t0 and (l - l0) / (t - t0) > 0:
+                exposure = t + (self.target - l) * (t - t0) / (l - l0)
+                exposure = min(max(exposure, t / MAX_STEP), t * MAX_STEP)
+        if saturated and exposure >= min(saturated):
+            # Beyond a saturated trial: bisect between it and the longest good one
+            exposure = float(np.sqrt(max(g[0] for g in good) * min(saturated)))
+        return exposure
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# guiding.py - Guide star centroids measured on the Pi
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# Instead of downloading a box around the guide star for every guide frame, the
+# client says where the star is and a Guider, as a capture.FrameLoop consumer,
+# measures it in each frame: sub-pixel centroid, flux and SNR. The box follows
+# the star, and each measurement goes into a ring of small records which the
+# client reads back, a few hundred bytes per frame rather than the whole box.
+
+import time
+import threading
+import numpy as np
+from collections import deque
+from imaging import stars
+
+RADIUS = 4                              # Half width, in luminance pixels, of the window measured around the peak
+
+def centroid(raw: np.ndarray, x: float, y: float, size: int, threshold: float = 5.0) -> dict:
+    """Measure the brightest star in a ``size`` box centred on (x, y) in
+    a raw Bayer frame. Positions are in raw pixels of the frame. Returns
+    found (False if the peak isn't ``threshold`` x noise above background),
+    x, y, flux (ADU above background), snr and peak (ADU)."""
+    height, width = raw.shape
+    size = max(8, size // 2 * 2)
+    # Keep the box on the Bayer grid and inside the frame
+    x0 = min(max(int(round(x - size / 2)) // 2 * 2, 0), max(width - size, 0) // 2 * 2)
+    y0 = min(max(int(round(y - size / 2)) // 2 * 2, 0), max(height - size, 0) // 2 * 2)
+    lum = stars.luminance(raw[y0:y0 + size, x0:x0 + size])
+    background = float(np.median(lum))
+    noise = max(float(np.median(np.abs(lum - background))) * 1.4826, 1e-3)
+    signal = lum - background
+    py, px = np.unravel_index(np.argmax(signal), signal.shape)
+    peak = float(signal[py, px])
+    if peak < threshold * noise:
+        return {'found': False, 'snr': round(peak / noise, 1)}
+    # Moments of the pixels above 3 x noise in a window round the peak
+    top, left = max(py - RADIUS, 0), max(px - RADIUS, 0)
+    window = signal[top:py + RADIUS + 1, left:px + RADIUS + 1]
+    window = np.where(window > 3 * noise, window, 0)
+    flux = float(window.sum())
+    cy = (window.sum(axis=1) * np.arange(window.shape[0])).sum() / flux + top
+    cx = (window.sum(axis=0) * np.arange(window.shape[1])).sum() / flux + left
+    pixels = np.count_nonzero(window)
+    return {
+        'found': True,
+        'x': x0 + 2 * cx + 0.5,         # Luminance pixel centres are between the raw ones
+        'y': y0 + 2 * cy + 0.5,
+        'flux': flux / 4,
+        'snr': flux / (noise * np.sqrt(pixels)),
+        'peak': (peak + background) / 4,
+    }
+
+class Guider:
+    """Measures the guide star in each frame as a capture.FrameLoop consumer,
+    keeping the last ``history`` records. Each record has a sequence number
+    ``n``, so a client can ask for those since the last it saw."""
+
+    def __init__(self, x: float, y: float, size: int, threshold: float = 5.0, history: int = 1000):
+        self.x = x
+        self.y = y
+        self.size = size
+        self.threshold = threshold
+        self.sequence = 0
+        self.lost = 0                   # Frames in a row without the star
+        self._records = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        t0 = time.perf_counter()
+        result = centroid(array, self.x, self.y, self.size, self.threshold)
+        if result['found']:
+            self.x, self.y = result['x'], result['y']       # Follow the star
+            self.lost = 0
+        else:
+            self.lost += 1
+        record = {k: round(float(v), 3) if k != 'found' else v for k, v in result.items()}
+        record['t'] = round(time.time(), 3)
+        record['ms'] = round((time.perf_counter() - t0) * 1000, 2)
+        with self._lock:
+            self.sequence += 1
+            record['n'] = self.sequence
+            self._records.append(record)
+
+    def records(self, since: int = 0) -> list:
+        """Records with a sequence number after ``since``, oldest first"""
+        with self._lock:
+            return [r for r in self._records if r['n'] > since]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# hotpixels.py - Hot pixel detection and correction
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# The map is just the flat int32 indices of the hot pixels in the binned
+# sensor frame, found in a dark by a robust threshold, and saved as .npy.
+#
+# Correction replaces each hot pixel with the median of its eight neighbours
+# of the same Bayer colour, which are two pixels away. The index arrays for a
+# subframe are worked out once and reused, so a frame costs one gather, one
+# median over a (pixels, 8) array and one scatter.
+
+import numpy as np
+
+# Same colour neighbours in a Bayer mosaic
+OFFSETS = np.array([(-2, -2), (-2, 0), (-2, 2), (0, -2), (0, 2), (2, -2), (2, 0), (2, 2)], dtype=np.int32)
+
+def detect(dark: np.ndarray, sigma: float = 6.0, min_excess: float = 20.0) -> np.ndarray:
+    """Flat int32 indices of pixels more than ``sigma`` robust standard
+    deviations, and at least ``min_excess`` ADU, above the median of the dark"""
+    median = float(np.median(dark))
+    mad = float(np.median(np.abs(dark - np.float32(median))))
+    threshold = median + max(sigma * 1.4826 * mad, min_excess)
+    return np.flatnonzero(dark > threshold).astype(np.int32)
+
+class HotPixelMap:
+    def __init__(self, indices: np.ndarray, width: int, height: int):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.width = width
+        self.height = height
+        self._key = None
+        self._targets = None
+        self._neighbours = None
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def load(cls, path: str, width: int, height: int):
+        return cls(np.load(path), width, height)
+
+    def save(self, path: str):
+        np.save(path, self.indices)
+
+    def _prepare(self, origin: tuple, shape: tuple):
+        """Target and neighbour coordinates within a subframe at origin (x, y)"""
+        key = (origin, shape)
+        if key == self._key:
+            return
+        height, width = shape
+        y = self.indices // self.width - origin[1]
+        x = self.indices % self.width - origin[0]
+        inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+        y, x = y[inside], x[inside]
+        ny = y[:, None] + OFFSETS[:, 0]
+        nx = x[:, None] + OFFSETS[:, 1]
+        # At the edges, use the neighbour on the other side instead
+        ny = np.where((ny < 0) | (ny >= height), y[:, None] - OFFSETS[:, 0], ny)
+        nx = np.where((nx < 0) | (nx >= width), x[:, None] - OFFSETS[:, 1], nx)
+        self._targets = (y, x)
+        self._neighbours = (np.clip(ny, 0, height - 1), np.clip(nx, 0, width - 1))
+        self._key = key
+
+    def correct(self, array: np.ndarray, origin: tuple = (0, 0)):
+        """Correct, in place, a raw subframe whose top left is at ``origin``
+        (x, y) in the binned sensor frame"""
+        self._prepare(tuple(origin), array.shape)
+        if len(self._targets[0]):
+            array[self._targets] = np.median(array[self._neighbours], axis=1)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# lucky.py - Lucky imaging: keep the sharpest frames, align and stack them
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# A Selector, as a capture.FrameLoop consumer, scores each frame of a burst
+# over a subframe by the variance of the Laplacian of its luminance, and keeps
+# the best K in a min-heap of preallocated buffers: a better frame is copied
+# over the worst one kept, so memory is fixed however long the burst.
+#
+# At the end the kept frames are aligned on the best by FFT phase correlation
+# and averaged. Shifts are whole 2x2 Bayer cells, so the colours still line
+# up, and each pixel is averaged over the frames that cover it.
+
+import heapq
+import numpy as np
+from imaging import stars
+
+def sharpness(raw: np.ndarray) -> float:
+    """Variance of the Laplacian of the luminance plane"""
+    lum = stars.luminance(raw)
+    laplacian = lum[1:-1, :-2] + lum[1:-1, 2:] + lum[:-2, 1:-1] + lum[2:, 1:-1] - 4 * lum[1:-1, 1:-1]
+    return float(laplacian.var())
+
+def shift(reference: np.ndarray, frame: np.ndarray) -> tuple:
+    """(dy, dx) in whole pixels to move frame by to line it up with the
+    reference, from the peak of their phase correlation"""
+    cross = np.fft.rfft2(reference) * np.conj(np.fft.rfft2(frame))
+    cross /= np.maximum(np.abs(cross), 1e-9)
+    correlation = np.fft.irfft2(cross, reference.shape)
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # Beyond half way round is a negative shift
+    height, width = reference.shape
+    return (dy - height if dy > height // 2 else dy), (dx - width if dx > width // 2 else dx)
+
+class Selector:
+    """Keeps the ``keep`` sharpest of the frames added, cropped to
+    (start_x, start_y, num_x, num_y)"""
+
+    def __init__(self, keep: int, start_x: int, start_y: int, num_x: int, num_y: int):
+        self.crop = (slice(start_y, start_y + num_y), slice(start_x, start_x + num_x))
+        self.origin = (start_x, start_y)
+        self.keep = keep
+        self._buffers = np.empty((keep, num_y, num_x), dtype=np.uint16)
+        self._heap = []                 # (score, frame index, buffer), worst at the top
+        self.frames = 0
+        self.total = 0.0                # Of all the scores, for the mean
+        self.metadata = None
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        frame = array[self.crop]
+        score = sharpness(frame)
+        self.frames += 1
+        self.total += score
+        if len(self._heap) < self.keep:
+            slot = len(self._heap)
+            heapq.heappush(self._heap, (score, index, slot))
+        elif score > self._heap[0][0]:
+            slot = self._heap[0][2]
+            heapq.heapreplace(self._heap, (score, index, slot))
+        else:
+            return
+        self._buffers[slot] = frame
+        self.metadata = metadata
+
+    def status(self) -> dict:
+        scores = sorted(s for s, _, _ in self._heap)
+        return {
+            'frames': self.frames,
+            'kept': len(scores),
+            'mean': round(self.total / self.frames, 2) if self.frames else None,
+            'best': round(scores[-1], 2) if scores else None,
+            'worst_kept': round(scores[0], 2) if scores else None,
+        }
+
+    def best(self) -> np.ndarray:
+        return self._buffers[max(self._heap)[2]].copy()
+
+    def stack(self, align: bool = True) -> np.ndarray:
+        """Mean of the kept frames, aligned on the sharpest, as uint16"""
+        order = [slot for _, _, slot in sorted(self._heap, reverse=True)]
+        height, width = self._buffers.shape[1:]
+        total = np.zeros((height, width), dtype=np.uint32)
+        count = np.zeros((height, width), dtype=np.uint16)
+        reference = stars.luminance(self._buffers[order[0]]) if align else None
+        if reference is not None:
+            reference -= reference.mean()
+        for slot in order:
+            frame = self._buffers[slot]
+            dy = dx = 0
+            if reference is not None:
+                lum = stars.luminance(frame)
+                dy, dx = shift(reference, lum - lum.mean())
+                dy, dx = 2 * dy, 2 * dx         # Whole Bayer cells
+            # The part of the frame that lands inside the subframe
+            target = (slice(max(dy, 0), height + min(dy, 0)), slice(max(dx, 0), width + min(dx, 0)))
+            source = (slice(max(-dy, 0), height + min(-dy, 0)), slice(max(-dx, 0), width + min(-dx, 0)))
+            np.add(total[target], frame[source], out=total[target])
+            count[target] += 1
+        return ((total + count // 2) // np.maximum(count, 1)).astype(np.uint16)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# meteors.py - Meteor and transient detection by frame differencing
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# Works on the binned luminance plane (see stars.luminance). A running mean and
+# variance of each pixel, updated with an exponential moving average, is the
+# background model; a pixel is lit if it's more than threshold x its own
+# standard deviation above the mean, so twinkling stars and noisy pixels look
+# after themselves. Lit pixels update the mean ten times more slowly, and not
+# the variance, so a transient barely touches the model but a lasting change
+# is learnt in the end.
+#
+# If enough pixels are lit, the frame is flagged: a line if their spread is
+# long and thin (meteors, satellites, aircraft) and a point otherwise. A
+# Monitor, as a capture.FrameLoop consumer, keeps the last few raw frames in a
+# ring of preallocated buffers, so the SER clip it records of each event
+# starts before the frame that triggered it.
+
+import os
+import time
+import threading
+import numpy as np
+from collections import deque
+from imaging import stars
+import recorder
+
+class Ring:
+    """The last ``size`` raw frames of (height, width), with their metadata"""
+
+    def __init__(self, size: int, height: int, width: int):
+        self._frames = np.empty((size, height, width), dtype=np.uint16)
+        self._metadata = [None] * size
+        self.count = 0
+
+    def add(self, frame: np.ndarray, metadata: dict):
+        if not len(self._frames):
+            return
+        i = self.count % len(self._frames)
+        self._frames[i] = frame
+        self._metadata[i] = metadata
+        self.count += 1
+
+    def frames(self) -> list:
+        """(frame, metadata), oldest first. The frames are views, valid until the next add"""
+        size = len(self._frames)
+        return [(self._frames[i % size], self._metadata[i % size]) for i in range(max(self.count - size, 0), self.count)]
+
+class Detector:
+    def __init__(self, binning: int = 2, threshold: float = 6.0, min_pixels: int = 4, alpha: float = 0.05,
+                 elongation: float = 3.0):
+        self.binning = binning
+        self.threshold = threshold
+        self.min_pixels = min_pixels
+        self.alpha = alpha
+        self.elongation = elongation
+        self.warmup = int(round(3 / alpha))     # Frames before the model is trusted
+        self.frames = 0
+        self._mean = None
+        self._var = None
+
+    def detect(self, raw: np.ndarray) -> dict:
+        """Update the model with a raw frame. Returns None, or the transient
+        found: kind (line or point), pixels lit, x, y (centre, raw pixels),
+        length (raw pixels) and peak (sigma)"""
+        plane = stars.luminance(raw, self.binning)
+        self.frames += 1
+        if self._mean is None or self._mean.shape != plane.shape:
+            self._mean = plane
+            self._var = np.full(plane.shape, max(stars.background(plane)[1] ** 2, 1.0), dtype=np.float32)
+            return None
+        diff = plane - self._mean
+        sigma = np.sqrt(self._var)
+        lit = diff > self.threshold * sigma
+        rate = np.where(lit, np.float32(self.alpha / 10), np.float32(self.alpha))
+        self._mean += rate * diff
+        rate[lit] = 0                           # A transient would blow up the variance
+        self._var += rate * (diff * diff - self._var)
+        count = int(np.count_nonzero(lit))
+        if self.frames <= self.warmup or count < self.min_pixels:
+            return None
+        y, x = np.nonzero(lit)
+        # Principal axes of the lit pixels
+        cov = np.cov(np.vstack((x, y)).astype(np.float64)) if count > 1 else np.zeros((2, 2))
+        major, minor = np.sqrt(np.maximum(np.linalg.eigvalsh(cov)[::-1], 0))
+        scale = 2 * self.binning                # Plane to raw pixels
+        length = np.sqrt(12) * major * scale    # A uniform streak's standard deviation is length / sqrt(12)
+        line = major > self.elongation * max(minor, 0.5) and length >= 4 * scale
+        return {
+            'kind': 'line' if line else 'point',
+            'pixels': count,
+            'x': round(float(x.mean() + 0.5) * scale - 0.5, 1),
+            'y': round(float(y.mean() + 0.5) * scale - 0.5, 1),
+            'length': round(float(length), 1),
+            'peak': round(float((diff[lit] / sigma[lit]).max()), 1),
+        }
+
+class Monitor:
+    """Runs a Detector on the (start_x, start_y, num_x, num_y) subframe of
+    each frame, and records a clip of ``pre`` frames before each event to
+    ``post`` frames after the last, at most ``max_clip``, to an SER file."""
+
+    def __init__(self, detector: Detector, start_x: int, start_y: int, num_x: int, num_y: int, directory: str,
+                 pre: int = 5, post: int = 10, max_clip: int = 300, bayer: str = 'rggb', instrument: str = '',
+                 history: int = 1000):
+        self.detector = detector
+        self.crop = (slice(start_y, start_y + num_y), slice(start_x, start_x + num_x))
+        self.shape = (num_y, num_x)
+        self.directory = directory
+        self.pre = pre
+        self.post = post
+        self.max_clip = max_clip
+        self.bayer = bayer
+        self.instrument = instrument
+        self.ring = Ring(pre, num_y, num_x)
+        self.sequence = 0
+        self.clips = 0
+        self._events = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._clip = None
+        self._remaining = 0
+        self._clock = time.time() - time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        frame = array[self.crop]
+        event = self.detector.detect(frame)
+        if event is not None:
+            if self._clip is None:
+                self._start_clip()
+            event.update({'time': round(time.time(), 3), 'file': self._clip.writer.path})
+            self._remaining = self.post
+            with self._lock:
+                self.sequence += 1
+                event['n'] = self.sequence
+                self._events.append(event)
+        if self._clip is not None:
+            self._clip.add(frame, metadata)
+            self._remaining -= event is None
+            if self._remaining <= 0 or self._clip.frames >= self.max_clip:
+                self._end_clip()
+        self.ring.add(frame, metadata)
+
+    def _start_clip(self):
+        path = os.path.join(self.directory, time.strftime('%Y%m%d-%H%M%S') + f'-{self.clips + 1}.ser')
+        writer = recorder.SerWriter(path, self.shape[1], self.shape[0], self.bayer, 12, self.instrument)
+        self._clip = recorder.Recorder(writer, 0, 0, self.shape[1], self.shape[0], self.pre + 8, self._clock)
+        for frame, metadata in self.ring.frames():
+            self._clip.add(frame, metadata)
+        self.clips += 1
+
+    def _end_clip(self):
+        # Finish writing on another thread, so the capture isn't held up
+        threading.Thread(target=self._clip.close, name='MeteorClip', daemon=True).start()
+        self._clip = None
+
+    def close(self):
+        if self._clip is not None:
+            self._clip.close()
+            self._clip = None
+
+    def events(self, since: int = 0) -> list:
+        """Events with a sequence number after ``since``, oldest first"""
+        with self._lock:
+            return [e for e in self._events if e['n'] > since]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# photometry.py - Aperture photometry of every frame, for light curves
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# For occultation and exoplanet timing only the light curve has to leave the
+# Pi. A Photometer, as a capture.FrameLoop consumer, measures the target and
+# comparison stars in each frame and puts one row per frame into a Ring:
+# fixed size NumPy arrays that the client drains in bulk.
+#
+# The apertures are worked out once as index arrays into a box around each
+# star, so a frame costs one gather of (stars, box, box) pixels, a sum over the
+# aperture and a median over the background annulus. The pixels are raw Bayer
+# data, so each aperture adds up all the colours.
+
+import threading
+import numpy as np
+
+class Ring:
+    """The last ``capacity`` rows of sequence number, sensor timestamp,
+    exposure and, per aperture, flux and background"""
+
+    def __init__(self, capacity: int, apertures: int):
+        self.capacity = capacity
+        self.sequence = 0               # Rows ever added
+        self.n = np.zeros(capacity, dtype=np.int64)
+        self.t = np.zeros(capacity, dtype=np.float64)
+        self.exposure = np.zeros(capacity, dtype=np.float32)
+        self.flux = np.zeros((capacity, apertures), dtype=np.float32)
+        self.background = np.zeros((capacity, apertures), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def add(self, t: float, exposure: float, flux: np.ndarray, background: np.ndarray):
+        with self._lock:
+            i = self.sequence % self.capacity
+            self.sequence += 1
+            self.n[i] = self.sequence
+            self.t[i] = t
+            self.exposure[i] = exposure
+            self.flux[i] = flux
+            self.background[i] = background
+
+    def read(self, since: int = 0, limit: int = None) -> dict:
+        """Columns of the rows after sequence number ``since``, oldest first,
+        at most ``limit`` of them. Rows overwritten before being read are lost;
+        ``dropped`` says how many."""
+        with self._lock:
+            first = max(since, self.sequence - self.capacity)
+            last = self.sequence if limit is None else min(self.sequence, first + limit)
+            rows = np.arange(first, last) % self.capacity
+            return {
+                'dropped': first - since,
+                'n': self.n[rows].tolist(),
+                't': self.t[rows].tolist(),
+                'exposure': self.exposure[rows].tolist(),
+                'flux': self.flux[rows].tolist(),
+                'background': self.background[rows].tolist(),
+            }
+
+class Photometer:
+    """Measures stars at fixed ``positions`` [(x, y), ...] in raw pixels of
+    the frame, with a circular aperture of ``radius`` and the background from
+    the median of an annulus from ``inner`` to ``outer``. The first position is
+    usually the target and the rest comparisons."""
+
+    def __init__(self, positions: list, radius: float, inner: float, outer: float, ring: Ring):
+        if not 0 < radius <= inner < outer:
+            raise ValueError('Need 0 < radius <= inner < outer')
+        self.ring = ring
+        half = int(np.ceil(outer))
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        # The box around each star, and which of its pixels are aperture and annulus
+        self.x0 = np.round(positions[:, 0]).astype(np.int64) - half
+        self.y0 = np.round(positions[:, 1]).astype(np.int64) - half
+        offsets = np.arange(2 * half + 1)
+        self._rows = self.y0[:, None, None] + offsets[None, :, None]
+        self._cols = self.x0[:, None, None] + offsets[None, None, :]
+        dy = self._rows - positions[:, 1, None, None]
+        dx = self._cols - positions[:, 0, None, None]
+        r = np.sqrt(dx * dx + dy * dy)
+        self._aperture = r <= radius
+        self._annulus = (r >= inner) & (r <= outer)
+        self.area = self._aperture.sum(axis=(1, 2))
+        self.frames = 0
+
+    def fits(self, width: int, height: int) -> bool:
+        """Whether every box is inside a frame of this size"""
+        return bool((self._rows.min() >= 0) and (self._cols.min() >= 0)
+                    and (self._rows.max() < height) and (self._cols.max() < width))
+
+    def measure(self, array: np.ndarray) -> tuple:
+        """(flux above background, background per pixel) of each star"""
+        cut = array[self._rows, self._cols].astype(np.float32)
+        annulus = np.where(self._annulus, cut, np.nan).reshape(len(cut), -1)
+        background = np.nanmedian(annulus, axis=1)
+        flux = np.where(self._aperture, cut, 0).sum(axis=(1, 2)) - background * self.area
+        return flux, background
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        flux, background = self.measure(array)
+        self.ring.add(metadata.get('SensorTimestamp', 0) / 1e9, metadata.get('ExposureTime', 0) / 1e6,
+                      flux, background)
+        self.frames += 1
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# stars.py - Star detection and HFR/FWHM measurement on raw frames
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# Works on a luminance plane made by adding each 2x2 Bayer cell (optionally
+# binned further), so colour doesn't matter and there's a quarter of the data:
+#
+#   1. Background and noise from the median and MAD of tiles
+#   2. Stars are local maxima more than threshold x noise above the background
+#   3. For each star, a box around it gives the centroid, flux, HFR and FWHM,
+#      counting only pixels more than 3 x noise above the background, as the
+#      noise in the rest of the box would otherwise swell the faint stars.
+#      Stars with too few such pixels to size are dropped
+#
+# Everything is whole-array NumPy; the stars are measured together as one
+# (stars, box, box) array. Sizes are returned in raw pixels.
+
+import numpy as np
+
+TILE = 32                               # Background tile size, in luminance pixels
+BOX = 7                                 # Half width of the box measured around each star
+FLOOR = 3.0                             # Pixels below this x noise don't count towards a star
+MIN_PIXELS = 4                          # Fewer above the floor than this is noise, or too faint to size
+FWHM_PER_SIGMA = 2.3548
+
+def luminance(raw: np.ndarray, binning: int = 1) -> np.ndarray:
+    """Sum of each 2x2 Bayer cell, then summed over binning x binning cells"""
+    h, w = raw.shape[0] // (2 * binning) * 2 * binning, raw.shape[1] // (2 * binning) * 2 * binning
+    raw = raw[:h, :w]
+    lum = raw[0::2, 0::2].astype(np.float32)
+    lum += raw[0::2, 1::2]
+    lum += raw[1::2, 0::2]
+    lum += raw[1::2, 1::2]
+    if binning > 1:
+        lum = lum.reshape(h // 2 // binning, binning, w // 2 // binning, binning).sum(axis=(1, 3))
+    return lum
+
+def background(lum: np.ndarray, tile: int = TILE):
+    """Per pixel background, from tile medians, and the noise (robust sigma)"""
+    ty, tx = max(lum.shape[0] // tile, 1), max(lum.shape[1] // tile, 1)
+    th, tw = lum.shape[0] // ty, lum.shape[1] // tx
+    tiles = lum[:ty * th, :tx * tw].reshape(ty, th, tx, tw).transpose(0, 2, 1, 3).reshape(ty, tx, -1)
+    medians = np.median(tiles, axis=2)
+    mads = np.median(np.abs(tiles - medians[:, :, None]), axis=2)
+    # Nearest tile for each pixel; edge pixels beyond the last whole tile use it too
+    rows = np.minimum(np.arange(lum.shape[0]) // th, ty - 1)
+    cols = np.minimum(np.arange(lum.shape[1]) // tw, tx - 1)
+    return medians[rows[:, None], cols[None, :]], float(np.median(mads)) * 1.4826
+
+def find_peaks(signal: np.ndarray, threshold: float, border: int) -> tuple:
+    """(y, x) of pixels above threshold that are the maximum of their 3x3 neighbourhood"""
+    core = signal[1:-1, 1:-1]
+    peak = core > threshold
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                neighbour = signal[1 + dy:signal.shape[0] - 1 + dy, 1 + dx:signal.shape[1] - 1 + dx]
+                # Strictly greater than those before, so a flat top gives one peak
+                peak &= core > neighbour if (dy, dx) < (0, 0) else core >= neighbour
+    y, x = np.nonzero(peak)
+    y, x = y + 1, x + 1
+    keep = (y >= border) & (y < signal.shape[0] - border) & (x >= border) & (x < signal.shape[1] - border)
+    return y[keep], x[keep]
+
+def measure(signal: np.ndarray, y: np.ndarray, x: np.ndarray, floor: float = 0.0, box: int = BOX) -> dict:
+    """Centroid, flux, HFR and FWHM of each star, in plane pixels, from the
+    pixels of its box above ``floor``"""
+    offsets = np.arange(-box, box + 1)
+    cut = signal[y[:, None, None] + offsets[None, :, None], x[:, None, None] + offsets[None, None, :]]
+    cut = np.where(cut > floor, cut, 0)
+    pixels = np.count_nonzero(cut, axis=(1, 2))
+    flux = cut.sum(axis=(1, 2))
+    flux = np.where(flux > 0, flux, 1)
+    cy = (cut.sum(axis=2) * offsets).sum(axis=1) / flux
+    cx = (cut.sum(axis=1) * offsets).sum(axis=1) / flux
+    dy = offsets[None, :, None] - cy[:, None, None]
+    dx = offsets[None, None, :] - cx[:, None, None]
+    r2 = dy * dy + dx * dx
+    hfr = (np.sqrt(r2) * cut).sum(axis=(1, 2)) / flux
+    sigma = np.sqrt((r2 * cut).sum(axis=(1, 2)) / flux / 2)
+    return {'y': y + cy, 'x': x + cx, 'flux': flux, 'hfr': hfr, 'fwhm': sigma * FWHM_PER_SIGMA,
+            'pixels': pixels}
+
+def analyze(raw: np.ndarray, threshold: float = 5.0, binning: int = 1, saturation: float = None,
+            max_stars: int = 500) -> dict:
+    """Detect and measure the stars in a raw Bayer frame. Saturated stars,
+    where any raw pixel in the peak cell reaches ``saturation``, are skipped."""
+    lum = luminance(raw, binning)
+    bg, noise = background(lum)
+    signal = lum - bg
+    y, x = find_peaks(signal, threshold * max(noise, 1e-3), BOX + 1)
+    if saturation is not None and len(y):
+        cell = raw[(y * 2 * binning)[:, None], (x * 2 * binning)[:, None] + np.arange(2)[None, :]]
+        keep = cell.max(axis=1) < saturation
+        y, x = y[keep], x[keep]
+    # Brightest first, limited, and no star inside another's box
+    order = np.argsort(signal[y, x])[::-1][:max_stars * 2]
+    y, x = y[order], x[order]
+    taken = np.zeros(signal.shape, dtype=bool)
+    keep = []
+    for i in range(len(y)):
+        if not taken[y[i], x[i]]:
+            keep.append(i)
+            taken[y[i] - BOX:y[i] + BOX + 1, x[i] - BOX:x[i] + BOX + 1] = True
+            if len(keep) == max_stars:
+                break
+    y, x = y[keep], x[keep]
+    stars = measure(signal, y, x, FLOOR * noise)
+    stars = {k: v[stars['pixels'] >= MIN_PIXELS] for k, v in stars.items()}
+    y = stars['y']
+    scale = 2 * binning                 # Plane pixels to raw pixels
+    return {
+        'stars': len(y),
+        'hfr': round(float(np.median(stars['hfr']) * scale), 3) if len(y) else None,
+        'fwhm': round(float(np.median(stars['fwhm']) * scale), 3) if len(y) else None,
+        'background': round(float(np.median(bg)) / (4 * binning * binning), 1),
+        'noise': round(noise / (4 * binning * binning), 2),
+        'list': [(round(float((sx + 0.5) * scale - 0.5), 2), round(float((sy + 0.5) * scale - 0.5), 2), round(float(f), 1),
+                  round(float(h * scale), 3), round(float(fw * scale), 3))
+                 for sx, sy, f, h, fw in zip(stars['x'], stars['y'], stars['flux'], stars['hfr'], stars['fwhm'])],
+    }
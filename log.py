@@ -35,6 +35,8 @@
 # 01-Jan-2023   rbd 0.1 Initial edit, moved from config.py
 # 15-Jan-2023   rbd 0.1 Documentation. No logic changes.
 
+import atexit
+import queue
 import logging
 import logging.handlers
 import time
@@ -43,6 +45,23 @@ from config import Config
 global logger
 #logger: logging.Logger = None  # Master copy (root) of the logger
 logger = None                   # Safe on Python 3.7 but no intellisense in VSCode etc.
+queue_handler = None            # For its count of dropped records
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records rather than block when the queue is full"""
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def dropped() -> int:
+    """Number of log records dropped because the log queue was full"""
+    return queue_handler.dropped if queue_handler is not None else 0
 
 def init_logging():
     """ Create the logger - called at app startup
@@ -60,16 +79,24 @@ def init_logging():
         of logs to keep, as well as the max size (at which point the log will be rotated).
         A new log is started each time the app is started.
 
+        The only handler on the logger itself is a :py:class:`DroppingQueueHandler`. A
+        ``QueueListener`` thread takes records off the bounded queue and does the actual
+        stdout and file writes, including rotation, so none of that happens inside a
+        responder. If logging can't keep up, records are dropped and counted rather than
+        slowing down requests.
+
     Returns:
         Customized Python logger.
 
     """
+    global queue_handler
 
     logging.basicConfig(level=Config.log_level)
     logger = logging.getLogger()                # Root logger, see above
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s %(message)s', '%Y-%m-%dT%H:%M:%S')
     formatter.converter = time.gmtime           # UTC time
-    logger.handlers[0].setFormatter(formatter)  # This is the stdout handler, level set above
+    stdout_handler = logger.handlers[0]         # This is the stdout handler, level set above
+    stdout_handler.setFormatter(formatter)
     # Add a logfile handler, same formatter and level
     handler = logging.handlers.RotatingFileHandler('logs/camera.log',
                                                     mode='w',
@@ -79,14 +106,19 @@ def init_logging():
     handler.setLevel(Config.log_level)
     handler.setFormatter(formatter)
     handler.doRollover()                                            # Always start with fresh log
-    logger.addHandler(handler)
+    handlers = [handler]
+    if Config.log_to_stdout:
+        handlers.append(stdout_handler)
+    """
+        The stdout handler created by logging.basicConfig() comes off the
+        logger either way. If it's wanted, the listener thread drives it.
+    """
+    logger.removeHandler(stdout_handler)
+    queue_handler = DroppingQueueHandler(queue.Queue(Config.log_queue_size))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)                                  # Flush what's queued on exit
     if not Config.log_to_stdout:
-        """
-            This allows control of logging to stdout by simply
-            removing the stdout handler from the logger's
-            handler list. It's always handler[0] as created
-            by logging.basicConfig()
-        """
         logger.debug('Logging to stdout disabled in settings')
-        logger.removeHandler(logger.handlers[0])    # This is the stdout handler
-    return logger
\ No newline at end of file
+    return logger
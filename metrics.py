@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# metrics.py - Prometheus style /metrics endpoint
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# Counters and fixed-bucket histograms are plain Python numbers. Requests
+# update them, and so do the capture threads, as each capture loop ends, so
+# updates take one shared lock: += isn't atomic across threads, and a lost
+# increment is a wrong count for ever. It's held for a few bytecodes and never
+# contended for long. Scraping only reads them, without the lock, so it can't
+# hold up a camera operation; the worst it can see is a histogram that's one
+# observation behind.
+
+import time
+import threading
+from bisect import bisect_left
+from falcon import Request, Response
+
+# Seconds. Covers property polls (~1ms) up to full frame JSON downloads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()                    # For updates, from any thread
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        with _lock:
+            self.value += n
+
+class Gauge:
+    __slots__ = ('value', 'fn')
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn                            # If set, called at scrape time
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        bucket = bisect_left(self.buckets, value)
+        with _lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+# name -> (type, help, {labels tuple: metric})
+_families = {}
+
+def _metric(kind: str, name: str, help: str, labels: tuple, factory):
+    family = _families.setdefault(name, (kind, help, {}))[2]
+    m = family.get(labels)
+    if m is None:
+        m = family.setdefault(labels, factory())
+    return m
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return _metric('counter', name, help, labels, Counter)
+
+def gauge(name: str, help: str, labels: tuple = (), fn=None) -> Gauge:
+    return _metric('gauge', name, help, labels, lambda: Gauge(fn))
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return _metric('histogram', name, help, labels, lambda: Histogram(buckets))
+
+# Labels are ((name, value), ...) tuples
+def _labels(labels: tuple, extra: str = '') -> str:
+    items = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+def exposition() -> str:
+    """The current metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, (kind, help, family) in list(_families.items()):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, m in list(family.items()):
+            if kind == 'histogram':
+                counts = list(m.counts)
+                total = 0
+                for le, n in zip(m.buckets + ('+Inf',), counts):
+                    total += n
+                    le_label = 'le="%s"' % le
+                    lines.append(f'{name}_bucket{_labels(labels, le_label)} {total}')
+                lines.append(f'{name}_sum{_labels(labels)} {m.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {total}')
+            elif kind == 'gauge':
+                lines.append(f'{name}{_labels(labels)} {m.get()}')
+            else:
+                lines.append(f'{name}{_labels(labels)} {m.value}')
+    return '\n'.join(lines) + '\n'
+
+# ---------------------------
+# Camera and pipeline metrics
+# ---------------------------
+frames_captured = counter('alpaca_frames_captured_total', 'Exposures completed by the camera')
+bytes_sent = counter('alpaca_response_bytes_total', 'Response body bytes sent')
+conversion_seconds = histogram('alpaca_imagearray_conversion_seconds', 'Time to convert a raw frame to an ImageArray payload')
+
+def pipeline_restart(reason: str):
+    counter('alpaca_pipeline_restarts_total', 'Camera pipeline restarts', (('reason', reason),)).inc()
+
+# --------------------
+# Per-endpoint metrics
+# --------------------
+class MetricsMiddleware:
+    """Falcon middleware counting and timing every request by responder class"""
+
+    def process_request(self, req: Request, resp: Response):
+        req.context.metrics_start = time.perf_counter()
+
+    def process_response(self, req: Request, resp: Response, resource, req_succeeded: bool):
+        elapsed = time.perf_counter() - req.context.metrics_start
+        endpoint = type(resource).__name__ if resource is not None else 'none'
+        labels = (('endpoint', endpoint),)
+        counter('alpaca_requests_total', 'Requests by endpoint', labels).inc()
+        histogram('alpaca_request_duration_seconds', 'Request latency by endpoint', labels).observe(elapsed)
+        # HTTP failures, or Alpaca errors flagged by the response classes in shr.py
+        if not req_succeeded or req.context.get('alpaca_error', 0) != 0:
+            counter('alpaca_request_errors_total', 'Failed requests by endpoint', labels).inc()
+        if resp.data is not None:
+            bytes_sent.inc(len(resp.data))
+        elif resp.text is not None:
+            # Sent as UTF-8. isascii() is free, and spares encoding a JSON image again
+            bytes_sent.inc(len(resp.text) if resp.text.isascii() else len(resp.text.encode()))
+        elif resp.content_length is not None:
+            bytes_sent.inc(int(resp.content_length))       # Falcon gives back the header, a str
+
+# ---------
+# /metrics
+# ---------
+class metrics:
+    def on_get(self, req: Request, resp: Response):
+        resp.content_type = 'text/plain; version=0.0.4'
+        resp.text = exposition()
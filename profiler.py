@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# profiler.py - On-demand cProfile and tracemalloc capture
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# PUT /profile with Action=start profiles the next Requests requests, or all
+# requests for the next Seconds seconds, whichever comes first. The profile is
+# written to logs/ as a .pstats file plus a .txt summary of the Top entries.
+# A timer ends the Seconds even if no more requests come; cProfile only works
+# on the thread that enabled it, so if a request is being profiled when it
+# fires, that request stops the profile as it finishes.
+#
+# PUT /profile with Action=trace takes tracemalloc snapshots around the next
+# Frames imagearray downloads and writes the Top allocation sites and the peak
+# to logs/. GET /profile returns what's armed and the files written so far.
+
+import io
+import time
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from logging import Logger
+from falcon import Request, Response
+from shr import PropertyResponse, MethodResponse, get_request_field, log_request
+from exceptions import InvalidValueException
+
+logger: Logger = None
+
+_LOG_DIR = 'logs'
+_NULL = nullcontext()
+
+class Profiler:
+    def __init__(self):
+        self.profile = None
+        self.requests_left = 0
+        self.deadline = 0
+        self.trace_left = 0
+        self.top = 30
+        self.files = []
+        self._enabled = False
+        self._timer = None
+        self._lock = threading.Lock()           # The timer runs on its own thread
+
+    @property
+    def profiling(self) -> bool:
+        return self.profile is not None
+
+    def start(self, requests: int, seconds: float, top: int):
+        with self._lock:
+            self._cancel_timer()
+            self.profile = cProfile.Profile()
+            self.requests_left = requests if requests > 0 else -1    # -1 = no limit
+            self.deadline = time.monotonic() + seconds if seconds > 0 else 0
+            self.top = top
+            if seconds > 0:
+                self._timer = threading.Timer(seconds, self._expire)
+                self._timer.daemon = True
+                self._timer.start()
+        logger.info(f'Profiling started for {requests} requests / {seconds} secs')
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def _expire(self):
+        with self._lock:
+            if not self._enabled:               # Otherwise disable() stops it
+                self._stop()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _stop(self):
+        if self.profile is None:
+            return
+        self._cancel_timer()
+        profile, self.profile = self.profile, None
+        profile.disable()                       # In case we're inside a profiled request
+        self._enabled = False
+        name = f'{_LOG_DIR}/profile-{time.strftime("%Y%m%dT%H%M%S", time.gmtime())}'
+        profile.dump_stats(f'{name}.pstats')
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(self.top)
+        with open(f'{name}.txt', 'w') as f:
+            f.write(out.getvalue())
+        self.files += [f'{name}.pstats', f'{name}.txt']
+        logger.info(f'Profile written to {name}.pstats')
+
+    # Called by the middleware around each responder
+    def enable(self):
+        with self._lock:
+            if self.profile is not None:
+                self.profile.enable()
+                self._enabled = True
+
+    def disable(self):
+        with self._lock:
+            if not self._enabled:               # Not the request that started us
+                return
+            self._enabled = False
+            self.profile.disable()
+            if self.requests_left > 0:
+                self.requests_left -= 1
+            if self.requests_left == 0 or (self.deadline and time.monotonic() >= self.deadline):
+                self._stop()
+
+    def trace(self, frames: int, top: int):
+        self.trace_left = frames
+        self.top = top
+
+    def allocations(self, operation: str):
+        """Context manager taking tracemalloc snapshots around an operation, if armed"""
+        if self.trace_left <= 0:
+            return _NULL
+        return self._allocations(operation)
+
+    @contextmanager
+    def _allocations(self, operation: str):
+        self.trace_left -= 1
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if self.trace_left <= 0:
+                tracemalloc.stop()
+            name = f'{_LOG_DIR}/tracemalloc-{time.strftime("%Y%m%dT%H%M%S", time.gmtime())}-{operation}.txt'
+            with open(name, 'w') as f:
+                f.write(f'{operation}: peak {peak / 1e6:.1f} MB, retained {current / 1e6:.1f} MB\n\n')
+                for stat in after.compare_to(before, 'lineno')[:self.top]:
+                    f.write(f'{stat}\n')
+            self.files.append(name)
+            logger.info(f'Allocation trace written to {name}')
+
+profiler = Profiler()
+
+class ProfilerMiddleware:
+    """Falcon middleware that turns the profiler on around each responder"""
+
+    def process_resource(self, req: Request, resp: Response, resource, params):
+        profiler.enable()
+
+    def process_response(self, req: Request, resp: Response, resource, req_succeeded: bool):
+        profiler.disable()
+
+# ---------
+# /profile
+# ---------
+class profile:
+    def on_get(self, req: Request, resp: Response):
+        log_request(req)
+        value = {
+            'Profiling': profiler.profiling,
+            'RequestsLeft': max(profiler.requests_left, 0) if profiler.profiling else 0,
+            'TracesLeft': profiler.trace_left,
+            'Files': profiler.files
+        }
+        resp.text = PropertyResponse(value, req).json
+
+    def on_put(self, req: Request, resp: Response):
+        log_request(req)
+        action = get_request_field('Action', req).lower()      # Raises 400 bad request if missing
+        try:
+            requests = int(get_request_field('Requests', req, default='0'))
+            seconds = float(get_request_field('Seconds', req, default='0'))
+            frames = int(get_request_field('Frames', req, default='1'))
+            top = int(get_request_field('Top', req, default='30'))
+        except ValueError:
+            resp.text = MethodResponse(req, InvalidValueException('Requests, Seconds, Frames and Top must be numbers')).json
+            return
+        if action == 'start':
+            if requests <= 0 and seconds <= 0:
+                resp.text = MethodResponse(req, InvalidValueException('Give Requests and/or Seconds')).json
+                return
+            profiler.start(requests, seconds, top)
+        elif action == 'stop':
+            profiler.stop()
+        elif action == 'trace':
+            profiler.trace(frames, top)
+        else:
+            resp.text = MethodResponse(req, InvalidValueException(f'Unknown Action {action}')).json
+            return
+        resp.text = MethodResponse(req).json
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# recorder.py - Recording raw video to SER files on the Pi
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# A Recorder is a capture.FrameLoop consumer that copies each frame's subframe
+# into one of a fixed set of preallocated buffers and hands it to its own
+# writer thread, so a slow write never holds up the capture. If the writer
+# falls so far behind that every buffer is full, the frame is dropped and
+# counted rather than waited for.
+#
+# SerWriter writes the SER format used by planetary capture and stacking
+# software: a 178 byte header, the frames as little endian uint16, and a
+# trailer of UTC timestamps. The file is preallocated when the number of
+# frames is known, and each frame goes to the disk in a single write.
+
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from logging import Logger
+from sensor.bayeroffset import BayerOffset
+
+logger: Logger = None
+
+# SER ColorID for each Bayer pattern
+COLOURS = {'mono': 0, 'rggb': 8, 'grbg': 9, 'gbrg': 10, 'bggr': 11}
+EPOCH = 621355968000000000              # 1970-01-01 in 100ns ticks since 0001-01-01
+HEADER = struct.Struct('<14s7i40s40s40sqq')
+
+def ticks(unix: float) -> int:
+    """SER timestamp (100ns ticks since 0001-01-01) of a Unix time"""
+    return EPOCH + int(round(unix * 1e7))
+
+def bayer_name(offset_x: int, offset_y: int, start_x: int = 0, start_y: int = 0) -> str:
+    """Bayer pattern of a subframe starting at (start_x, start_y), given the
+    sensor's Bayer offsets"""
+    offsets = ((offset_x + start_x) % 2, (offset_y + start_y) % 2)
+    return next(name for name, o in BayerOffset.offset_names.items() if o == offsets)
+
+class SerWriter:
+    """Writes uint16 frames of width x height to an SER file. ``expected``
+    frames, if given, are preallocated on the disk."""
+
+    def __init__(self, path: str, width: int, height: int, bayer: str = 'rggb', depth: int = 12,
+                 instrument: str = '', observer: str = '', telescope: str = '', expected: int = None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.frame_bytes = width * height * 2
+        self.frames = 0
+        self._header = (COLOURS[bayer.lower()], depth, instrument, observer, telescope)
+        self._timestamps = []
+        self._start = time.time()
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if expected and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, HEADER.size + expected * (self.frame_bytes + 8))
+            except OSError as ex:
+                logger.warning(f'Could not preallocate {path}: {ex}')
+        self._write_header()
+
+    def _write_header(self):
+        start = self._start
+        colour, depth, instrument, observer, telescope = self._header
+        # LittleEndian is 0: the spec says otherwise, but that's what capture software writes
+        header = HEADER.pack(b'LUCAM-RECORDER', 0, colour, 0, self.width, self.height, depth, self.frames,
+                             observer.encode()[:40], instrument.encode()[:40], telescope.encode()[:40],
+                             ticks(start - time.timezone), ticks(start))
+        os.pwrite(self._fd, header, 0)
+
+    def write(self, frame: np.ndarray, timestamp: float):
+        """Append a frame, with its Unix time"""
+        data = memoryview(np.ascontiguousarray(frame, dtype='<u2')).cast('B')
+        offset = HEADER.size + self.frames * self.frame_bytes
+        while data:
+            written = os.pwrite(self._fd, data, offset)
+            data, offset = data[written:], offset + written
+        if not self.frames:
+            self._start = timestamp
+        self.frames += 1
+        self._timestamps.append(ticks(timestamp))
+
+    def close(self):
+        """Write the timestamps and the frame count, and trim any unused preallocation"""
+        if self._fd is None:
+            return
+        end = HEADER.size + self.frames * self.frame_bytes
+        trailer = np.array(self._timestamps, dtype='<u8').tobytes()
+        os.pwrite(self._fd, trailer, end)
+        os.ftruncate(self._fd, end + len(trailer))
+        self._write_header()
+        os.close(self._fd)
+        self._fd = None
+
+class Recorder:
+    """Copies the (start_x, start_y, num_x, num_y) subframe of each frame into
+    one of ``buffers`` preallocated buffers, for the writer thread to write
+    with ``writer.write``. ``clock`` is added to SensorTimestamp to give Unix time."""
+
+    def __init__(self, writer: SerWriter, start_x: int, start_y: int, num_x: int, num_y: int,
+                 buffers: int = 32, clock: float = None):
+        self.writer = writer
+        self.crop = (slice(start_y, start_y + num_y), slice(start_x, start_x + num_x))
+        self.clock = time.time() - time.monotonic() if clock is None else clock
+        self.frames = 0                 # Frames captured
+        self.dropped = 0                # ...that the writer couldn't keep up with
+        self.missed = 0                 # Gaps in the sensor timestamps, frames the capture didn't keep up with
+        self.error = None
+        self._last = None
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(np.empty((num_y, num_x), dtype=np.uint16))
+        self._full = queue.Queue()
+        self._started = time.perf_counter()
+        self._stopped = None
+        self._writing = 0.0             # Seconds spent writing
+        self._thread = threading.Thread(target=self._run, name='SerWriter', daemon=True)
+        self._thread.start()
+
+    def add(self, array: np.ndarray, metadata: dict, index: int = 0):
+        self.frames += 1
+        timestamp = metadata.get('SensorTimestamp')
+        if timestamp is not None and self._last is not None and 'FrameDuration' in metadata:
+            gap = (timestamp - self._last) / 1e3 / metadata['FrameDuration']      # ns against us
+            self.missed += max(int(round(gap)) - 1, 0)
+        self._last = timestamp
+        try:
+            buffer = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        np.copyto(buffer, array[self.crop])
+        self._full.put((buffer, self.clock + timestamp / 1e9 if timestamp is not None else time.time()))
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            buffer, timestamp = item
+            try:
+                if self.error is None:
+                    t0 = time.perf_counter()
+                    self.writer.write(buffer, timestamp)
+                    self._writing += time.perf_counter() - t0
+            except OSError as ex:
+                self.error = ex
+                logger.error(f'Writing {self.writer.path} failed: {ex}')
+            finally:
+                self._free.put(buffer)
+
+    def close(self):
+        """Write out what's queued and finish the file"""
+        if self._stopped is not None:
+            return
+        self._stopped = time.perf_counter()
+        self._full.put(None)
+        self._thread.join()
+        self.writer.close()
+
+    def status(self) -> dict:
+        elapsed = (self._stopped or time.perf_counter()) - self._started
+        written = self.writer.frames * self.writer.frame_bytes
+        queued = self._full.qsize()
+        if self._stopped is not None and self._thread.is_alive():
+            queued = max(queued - 1, 0)         # Not the end marker close() queued
+        return {
+            'file': self.writer.path,
+            'frames': self.frames,
+            'written': self.writer.frames,
+            'dropped': self.dropped,
+            'missed': self.missed,
+            'queued': queued,
+            'seconds': round(elapsed, 1),
+            'fps': round(self.frames / elapsed, 2) if elapsed > 0 else None,
+            'mb_per_s': round(written / elapsed / 1e6, 2) if elapsed > 0 else None,
+            'disk_mb_per_s': round(written / self._writing / 1e6, 1) if self._writing > 0 else None,
+            'error': None if self.error is None else str(self.error),
+        }
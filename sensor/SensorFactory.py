@@ -1,5 +1,5 @@
-from picamera2 import Picamera2
 from logging import Logger
+from backend.BackendFactory import BackendFactory
 from sensor.sensor import Sensor
 from sensor.IMX477 import IMX477
 
@@ -11,7 +11,7 @@ class SensorFactory:
 
     @staticmethod
     def get_sensor():
-        cameras = Picamera2.global_camera_info()
+        cameras = BackendFactory.get_camera_class().global_camera_info()
 
         if len(cameras) == 0:
             raise Exception("No cameras found!")
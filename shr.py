@@ -63,8 +63,10 @@ from threading import Lock
 from exceptions import Success
 import orjson
 from falcon import Request, Response, HTTPBadRequest
-from logging import Logger
+from logging import Logger, DEBUG
 import struct
+import time
+import zlib
 import numpy as np
 
 logger: Logger = None
@@ -72,6 +74,11 @@ logger: Logger = None
 
 _bad_title = 'Bad Alpaca Request'
 
+# Content type for the byte-shuffled, delta-predicted and deflated variant of
+# ImageBytes. This isn't part of the Alpaca spec, it's for our own tooling
+SHUFFLE_CONTENT_TYPE = 'application/x-imagebytes-shuffle'
+SHUFFLE_LEVEL = 1                       # zlib level. Higher levels gain little on shuffled data
+
 def set_shr_logger(lgr):
     global logger
     logger = lgr
@@ -127,11 +134,47 @@ def get_request_field(name: str, req: Request, caseless: bool = False, default:
             raise HTTPBadRequest(title=_bad_title, description=bad_desc)                # Missing or incorrect casing
         return default
 
+# ---------------
+# Traffic Capture
+# ---------------
+class TrafficRecorder:
+    """Records every Alpaca request to a file so a session can be replayed
+
+    One compact JSON object per line. The first line holds the wall clock
+    start time, then each request is ``{"t": secs since start, "m": method,
+    "p": path, "q": {params}}`` plus ``"a"`` for the Accept header when the
+    client sent one. Replay with ``python -m util.replay``.
+    """
+    def __init__(self, path: str):
+        self._lock = Lock()
+        self._file = open(path, 'ab')
+        self._start = time.monotonic()
+        self._file.write(orjson.dumps({'start': time.time()}) + b'\n')
+        self._file.flush()
+
+    def record(self, req: Request):
+        entry = {'t': round(time.monotonic() - self._start, 4), 'm': req.method, 'p': req.path,
+                 'q': dict(req.params) if req.method == 'GET' else dict(req.get_media())}
+        if req.accept != '*/*':
+            entry['a'] = req.accept
+        line = orjson.dumps(entry) + b'\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()              # So a crash still leaves a usable recording
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+traffic: TrafficRecorder = None             # Set up by app.create_app() when enabled in config
+
 #
 # Log the request as soon as the resource handler gets it so subsequent
 # logged messages are in the right order. Logs PUT body as well.
 #
 def log_request(req: Request):
+    if not logger.isEnabledFor(DEBUG):          # Skip the formatting (and PUT body parse)
+        return
     msg = f'{req.remote_addr} -> {req.method} {req.path}'
     if req.query_string != '':
         msg += f'?{req.query_string}'
@@ -198,6 +241,8 @@ class PreProcessRequest():
     #
     def __call__(self, req: Request, resp: Response, resource, params):
         log_request(req)                            # Log even a bad request
+        if traffic is not None:
+            traffic.record(req)                     # Record even a bad request, for a faithful replay
         self._check_request(req, params['devnum'])   # Raises to 400 error on check failure
 
 # ------------------
@@ -220,9 +265,11 @@ class PropertyResponse():
         """
         self.ServerTransactionID = getNextTransId()
         self.ClientTransactionID = int(get_request_field('ClientTransactionID', req, False, 0))  #Caseless on GET
+        req.context.alpaca_error = err.Number   # For the metrics middleware
         if err.Number == 0 and not value is None:
             self.Value = value
-            logger.debug(f'{req.remote_addr} <- {str(value)[:100]}')
+            if logger.isEnabledFor(DEBUG):      # str() of an ImageArray is very expensive
+                logger.debug(f'{req.remote_addr} <- {str(value)[:100]}')
         self.ErrorNumber = err.Number
         self.ErrorMessage = err.Message
 
@@ -275,7 +322,7 @@ class ImageArrayResponse(PropertyResponse):
             # Obtain the byte string
             b = data_array.tobytes(order='C')
 
-            return struct.pack(f"<IIIIIIIIIII{str(self.Value.nbytes)}s",
+            return struct.pack(f"<IIIIIIIIIII{len(b)}s",
                 1,                              # Metadata Version = 1
                 self.ErrorNumber,               
                 self.ClientTransactionID,
@@ -291,21 +338,83 @@ class ImageArrayResponse(PropertyResponse):
                 )
 
         else:
-            error_message = self.ErrorMessage.encode('utf-8')
-            return struct.pack(f"<IIIIIIIIIII{len(error_message)}s",
+            return self._error_binary()
+
+    @property
+    def shuffled(self) -> bytes:
+        # Return the ImageBytes header followed by the shuffle_encode()d image
+        if (self.ErrorNumber == 0):
+            return struct.pack("<IIIIIIIIIII",
                 1,                              # Metadata Version = 1
-                self.ErrorNumber,               
+                self.ErrorNumber,
                 self.ClientTransactionID,
                 self.ServerTransactionID,
                 44,                             # DataStart
-                0,                              # ImageElementType = 2 = uint32
-                0,                              # TransmissionElementType = 8 = uint16
-                0,                              # Rank = 2 = bayer
-                0,                              # length of column
-                0,                              # length of rows
+                2,                              # ImageElementType = 2 = int32
+                8,                              # TransmissionElementType = 8 = uint16
+                self.Rank,                      # Rank = 2 = bayer
+                self.Value.shape[0],            # length of column
+                self.Value.shape[1],            # length of rows
                 0,                              # 0 for 2d array
-                error_message                   # UTF8 encoded error message
-                )
+                ) + shuffle_encode(self.Value)
+        else:
+            return self._error_binary()
+
+    def _error_binary(self) -> bytes:
+        error_message = self.ErrorMessage.encode('utf-8')
+        return struct.pack(f"<IIIIIIIIIII{len(error_message)}s",
+            1,                              # Metadata Version = 1
+            self.ErrorNumber,               
+            self.ClientTransactionID,
+            self.ServerTransactionID,
+            44,                             # DataStart
+            0,                              # ImageElementType = 2 = uint32
+            0,                              # TransmissionElementType = 8 = uint16
+            0,                              # Rank = 2 = bayer
+            0,                              # length of column
+            0,                              # length of rows
+            0,                              # 0 for 2d array
+            error_message                   # UTF8 encoded error message
+            )
+
+# ------------------------------------
+# Byte-shuffled lossless image payloads
+# ------------------------------------
+# Deflate does poorly on raw little-endian uint16 because the noisy low bytes
+# are interleaved with the highly redundant high bytes. Before deflating we:
+#
+#   1. Drop the low bits that are zero in every pixel (the 12 to 16 bit shift)
+#   2. Replace each pixel with its difference from the pixel two places along
+#      the same sensor row, so from the same Bayer colour
+#   3. Zigzag the signed differences so small negatives become small positives
+#   4. Split the result into a plane of low bytes then a plane of high bytes
+#
+# The payload is one byte holding the number of dropped bits, then the zlib
+# stream. The array is the transposed ImageArray, so axis 0 is sensor X.
+def shuffle_encode(value: np.ndarray, level: int = SHUFFLE_LEVEL) -> bytes:
+    a = np.ascontiguousarray(value, dtype='<u2')
+    used = int(np.bitwise_or.reduce(a, axis=None))
+    shift = (used & -used).bit_length() - 1 if used else 0
+    if shift:
+        a = a >> shift
+    d = np.empty_like(a)
+    d[:2] = a[:2]
+    np.subtract(a[2:], a[:-2], out=d[2:])       # Wraps modulo 2^16, we undo that on decode
+    s = d.view('<i2')
+    d = (d << 1) ^ (s >> 15).view('<u2')        # Zigzag
+    planes = d.view(np.uint8).reshape(-1, 2).T  # [low bytes, high bytes]
+    return bytes([shift]) + zlib.compress(np.ascontiguousarray(planes), level)
+
+def shuffle_decode(payload: bytes, shape: tuple) -> np.ndarray:
+    planes = np.frombuffer(zlib.decompress(payload[1:]), dtype=np.uint8).reshape(2, -1)
+    d = np.empty(planes.shape[1], dtype='<u2')
+    d.view(np.uint8).reshape(-1, 2)[:] = planes.T
+    d = (d >> 1) ^ (-(d & 1).view('<i2')).view('<u2')  # Un-zigzag
+    d = d.reshape(shape)
+    a = np.empty_like(d)
+    np.cumsum(d[0::2], axis=0, dtype='<u2', out=a[0::2])
+    np.cumsum(d[1::2], axis=0, dtype='<u2', out=a[1::2])
+    return a << payload[0]
 
 # --------------
 # MethodResponse
@@ -328,9 +437,11 @@ class MethodResponse():
         # This is crazy ... if casing is incorrect here, we're supposed to return the default 0
         # even if the caseless check coming in returned a valid number. This is for PUT only.
         self.ClientTransactionID = int(get_request_field('ClientTransactionID', req, False, 0))
+        req.context.alpaca_error = err.Number   # For the metrics middleware
         if err.Number == 0 and not value is None:
             self.Value = value
-            logger.debug(f'{req.remote_addr} <- {str(value)}')
+            if logger.isEnabledFor(DEBUG):
+                logger.debug(f'{req.remote_addr} <- {str(value)}')
         self.ErrorNumber = err.Number
         self.ErrorMessage = err.Message
 
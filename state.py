@@ -47,3 +47,20 @@ class State:
                 self.start_y = 0
                 self.binning = 1
                 self.temperature = 0
+                self.exposure_started = 0           # time.perf_counter() at capture_request
+                self.subexposure_duration = 0       # Live stacking when > 0 and less than the exposure
+                self.frame_loop = None              # capture.FrameLoop while stacking
+                self.stacked = None                 # (array, bits, metadata, origin) from the last stack
+                self.calibration = None             # Progress of the last calibration capture
+                self.calibrate = False              # Calibrate frames before download
+                self.correct_hotpixels = False      # Correct hot pixels before download
+                self.frame_id = 0                   # Counts frames downloaded
+                self.last_frame = None              # The last of them, as downloaded, for analysis
+                self.preview = None                 # (frame id, size, format, content type, bytes) last rendered
+                self.guider = None                  # Measures the guide star while guiding
+                self.photometer = None              # Measures the light curve in photometry mode
+                self.lucky = None                   # Progress of the last lucky imaging burst
+                self.recorder = None                # Writing an SER file
+                self.allsky = None                  # All-sky camera mode
+                self.meteors = None                 # Meteor detection mode
+                self.flat_solve = None              # Progress of the last flat exposure search
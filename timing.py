@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------
+# timing.py - Per-stage timing of the exposure and download hot paths
+#
+# Author:   Ian Cass <ian@wheep.co.uk> https://astro.wheep.co.uk
+#
+# -----------------------------------------------------------------------------
+# Each operation on a frame (startexposure, oncapturefinished, imagearray) gets
+# a FrameTiming, and each stage within it is timed with a span:
+#
+#   f = timing.recorder.frame('imagearray')
+#   with f.span('make_array'):
+#       array = request.make_array('raw')
+#   timing.recorder.commit(f)
+#
+# When timing is disabled, frame() hands back a shared do-nothing object so
+# the cost is a couple of attribute lookups per stage. Completed frames go
+# into a ring buffer, exposed by the /timing endpoint, and a one line summary
+# of each is logged at INFO.
+
+import time
+from collections import deque
+from logging import Logger
+from falcon import Request, Response
+from config import Config
+from shr import PropertyResponse, MethodResponse, get_request_field, to_bool, log_request
+
+logger: Logger = None
+
+class FrameTiming:
+    """Stage timings for one operation on one frame"""
+    __slots__ = ('operation', 'started', 'spans')
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.started = time.time()
+        self.spans = []
+
+    def span(self, name: str):
+        return _Span(self, name)
+
+    def record(self, name: str, seconds: float):
+        """Record a stage that was timed elsewhere"""
+        self.spans.append((name, seconds))
+
+    def as_dict(self) -> dict:
+        return {
+            'Operation': self.operation,
+            'Started': self.started,
+            'Spans': {name: round(seconds * 1000, 3) for name, seconds in self.spans}   # ms
+        }
+
+class _Span:
+    __slots__ = ('frame', 'name', 't0')
+
+    def __init__(self, frame: FrameTiming, name: str):
+        self.frame = frame
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.frame.spans.append((self.name, time.perf_counter() - self.t0))
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class _NullFrame:
+    __slots__ = ()
+
+    def span(self, name: str):
+        return _NULL_SPAN
+
+    def record(self, name: str, seconds: float):
+        pass
+
+_NULL_SPAN = _NullSpan()
+_NULL_FRAME = _NullFrame()
+
+class TimingRecorder:
+    """Ring buffer of FrameTimings. Benchmarks can make their own."""
+
+    def __init__(self, enabled: bool = False, history: int = 100, log: bool = True):
+        self.enabled = enabled
+        self.log = log
+        self.frames = deque(maxlen=history)
+
+    def frame(self, operation: str):
+        if not self.enabled:
+            return _NULL_FRAME
+        return FrameTiming(operation)
+
+    def commit(self, frame):
+        if frame is _NULL_FRAME:
+            return
+        self.frames.append(frame)
+        if self.log and logger is not None:
+            stages = ' '.join([f'{name}={seconds * 1000:.1f}ms' for name, seconds in frame.spans])
+            logger.info(f'Timing {frame.operation}: {stages}')
+
+    def stream(self, frame, data: bytes, chunk_size: int = 1 << 20):
+        """Yield data to the WSGI server in chunks, timing the socket writes"""
+        t0 = time.perf_counter()
+        view = memoryview(data)
+        try:
+            for i in range(0, len(view), chunk_size):
+                # wsgiref insists on bytes, so a chunk at a time is copied
+                yield bytes(view[i:i + chunk_size])
+        finally:
+            frame.record('write', time.perf_counter() - t0)
+            self.commit(frame)
+
+    def summary(self) -> dict:
+        """Mean and max of each stage per operation over the ring buffer, in ms"""
+        stages = {}
+        for frame in list(self.frames):
+            for name, seconds in frame.spans:
+                stages.setdefault(frame.operation, {}).setdefault(name, []).append(seconds)
+        return {op: {name: {'Count': len(v),
+                            'Mean': round(sum(v) / len(v) * 1000, 3),
+                            'Max': round(max(v) * 1000, 3)} for name, v in s.items()}
+                for op, s in stages.items()}
+
+recorder = TimingRecorder(Config.timing_enabled, Config.timing_history)
+
+# --------
+# /timing
+# --------
+class timings:
+    def on_get(self, req: Request, resp: Response):
+        log_request(req)
+        value = {
+            'Enabled': recorder.enabled,
+            'Summary': recorder.summary(),
+            'Frames': [f.as_dict() for f in list(recorder.frames)]
+        }
+        resp.text = PropertyResponse(value, req).json
+
+    def on_put(self, req: Request, resp: Response):
+        log_request(req)
+        recorder.enabled = to_bool(get_request_field('Enabled', req))    # Raises 400 Bad Request if bad
+        if not recorder.enabled:
+            recorder.frames.clear()
+        resp.text = MethodResponse(req).json
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Benchmark the byte-shuffled ImageBytes codec in shr.py against plain deflate
+# on synthetic star fields, darks and flats at bin 1 and bin 2.
+#
+# Run from the top of the repo so config.toml is found:
+#
+#   python -m util.bench_codec [--repeat N]
+
+import sys
+import time
+import zlib
+import argparse
+import numpy as np
+from shr import shuffle_encode, shuffle_decode, SHUFFLE_LEVEL
+from backend.synthetic import Scene
+
+SIZE_X = 4056                           # IMX477
+SIZE_Y = 3040
+
+# Scene and exposure (secs)
+FRAMES = (('stars', 30.0), ('dark', 60.0), ('flat', 0.1))
+
+
+def to_imagearray(raw):
+    # Same representation as camera.imagearray sends: 12 bit data shifted to 16 bits, transposed
+    return np.transpose(raw << 4)
+
+def byte_shuffle(a):
+    return zlib.compress(np.ascontiguousarray(a, dtype='<u2').view(np.uint8).reshape(-1, 2).T.copy(), SHUFFLE_LEVEL)
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the shuffled ImageBytes codec')
+    parser.add_argument('--repeat', type=int, default=3, help='Take the best of N runs')
+    args = parser.parse_args()
+
+    print(f'{"frame":<10}{"bin":>4}{"codec":>16}{"ratio":>8}{"enc MB/s":>10}{"dec MB/s":>10}')
+    for name, exposure in FRAMES:
+        for binning in (1, 2):
+            a = to_imagearray(Scene(name, SIZE_X // binning, SIZE_Y // binning).frame(exposure))
+            mb = a.nbytes / 1e6
+            codecs = (
+                ('deflate', lambda: zlib.compress(a.tobytes(), SHUFFLE_LEVEL), None),
+                ('shuffle', lambda: byte_shuffle(a), None),
+                ('shuffle+delta', lambda: shuffle_encode(a), lambda p: shuffle_decode(p, a.shape)),
+            )
+            for codec, encode, decode in codecs:
+                payload, enc = timed(encode, args.repeat)
+                dec_rate = ''
+                if decode is not None:
+                    decoded, dec = timed(lambda: decode(payload), args.repeat)
+                    if not np.array_equal(decoded, a):
+                        print(f'ERROR: {codec} round trip failed for {name} bin {binning}')
+                        return 1
+                    dec_rate = f'{mb / dec:.1f}'
+                print(f'{name:<10}{binning:>4}{codec:>16}{a.nbytes / len(payload):>8.2f}{mb / enc:>10.1f}{dec_rate:>10}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
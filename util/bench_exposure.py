@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+# End-to-end exposure latency benchmark. Serves the real app in-process
+# against the simulated camera and drives it the way NINA does: connected,
+# gain, binx/biny, subframe, then startexposure, poll imageready, imagearray.
+#
+# For each duration/binning/subframe it reports the time from startexposure
+# to the first and last byte of the image, and the dead time between the
+# end of one exposure and the start of the next. Dead time is what directly
+# costs us integration time. The simulator's exposure and sensor readout both
+# take time_scale times as long; the readout is the sensor's, not the
+# server's, so it's reported separately and not counted as dead time.
+#
+# Run from the top of the repo so config.toml is found:
+#
+#   python -m util.bench_exposure [--exposures 5] [--output results.json]
+
+import sys
+import json
+import time
+import argparse
+import statistics
+from util.harness import serve, AlpacaClient
+from backend.SimulatorBackend import READOUT_TIME
+
+SIZE_X = 4056                           # IMX477
+SIZE_Y = 3040
+
+DURATIONS = (0.001, 0.5, 2.0)
+BINNINGS = (1, 2)
+SUBFRAMES = (None, 1024)                # None = whole frame
+
+
+def run(client: AlpacaClient, duration: float, binning: int, sub: int, exposures: int, poll: float, accept: str,
+        time_scale: float = 1.0) -> dict:
+    client.put('binx', BinX=binning)
+    client.put('biny', BinY=binning)
+    width, height = SIZE_X // binning, SIZE_Y // binning
+    if sub is None:
+        client.put('startx', StartX=0)
+        client.put('starty', StartY=0)
+        client.put('numx', NumX=width)
+        client.put('numy', NumY=height)
+    else:
+        client.put('startx', StartX=(width - sub) // 2)
+        client.put('starty', StartY=(height - sub) // 2)
+        client.put('numx', NumX=sub)
+        client.put('numy', NumY=sub)
+
+    first_bytes, last_bytes, starts, sizes = [], [], [], []
+    for _ in range(exposures):
+        t0 = time.perf_counter()
+        starts.append(t0)
+        client.put('startexposure', Duration=duration, Light='true')
+        while not client.get('imageready'):
+            time.sleep(poll)
+        t1 = time.perf_counter()
+        data, first, last = client.imagearray(accept)
+        first_bytes.append(t1 + first - t0)
+        last_bytes.append(t1 + last - t0)
+        sizes.append(len(data))
+    starts.append(time.perf_counter())
+    # Everything between the starts of consecutive exposures that isn't exposing or reading out
+    busy = (duration + READOUT_TIME) * time_scale
+    dead_times = [b - a - busy for a, b in zip(starts, starts[1:])]
+
+    def ms(values):
+        return round(statistics.median(values) * 1000, 1) if values else None
+
+    return {
+        'duration': duration, 'binning': binning, 'subframe': sub or 'full',
+        'first_byte_ms': ms(first_bytes), 'last_byte_ms': ms(last_bytes),
+        'dead_time_ms': ms(dead_times), 'readout_ms': round(READOUT_TIME * time_scale * 1000, 1),
+        'bytes': sizes[-1]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end exposure latency against the simulated camera')
+    parser.add_argument('--exposures', type=int, default=5, help='Exposures per combination')
+    parser.add_argument('--poll', type=float, default=0.05, help='imageready poll interval (secs)')
+    parser.add_argument('--accept', default='application/imagebytes', help='Accept header for imagearray')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='Simulator exposure/readout time multiplier')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    httpd = serve(args.time_scale)
+    client = AlpacaClient('127.0.0.1', httpd.server_port)
+    client.put('connected', Connected='true')
+    client.put('gain', Gain=1)
+
+    results = []
+    print(f'Simulated sensor readout {READOUT_TIME * args.time_scale * 1000:.1f} ms, not counted as dead time')
+    print(f'{"secs":>8}{"bin":>5}{"subframe":>10}{"first ms":>10}{"last ms":>10}{"dead ms":>10}{"MB":>8}')
+    for duration in DURATIONS:
+        for binning in BINNINGS:
+            for sub in SUBFRAMES:
+                r = run(client, duration, binning, sub, args.exposures, args.poll, args.accept, args.time_scale)
+                results.append(r)
+                print(f'{duration:>8}{binning:>5}{str(r["subframe"]):>10}{r["first_byte_ms"]:>10}'
+                      f'{r["last_byte_ms"]:>10}{r["dead_time_ms"]:>10}{r["bytes"] / 1e6:>8.1f}')
+
+    client.put('connected', Connected='false')
+    httpd.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
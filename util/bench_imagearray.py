@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Microbenchmark of the imagearray conversion chain: the 12 to 16 bit shift,
+# subframe crop and transpose in camera.raw_to_imagearray(), then ImageBytes
+# packing, the shuffled codec and JSON encoding in shr.ImageArrayResponse.
+#
+# Runs on synthetic IMX477 frames at full and binned resolution and at typical
+# subframe sizes. Reports MB/s of ImageArray produced, plus peak and retained
+# memory per stage from tracemalloc. Results can be written as JSON, and
+# compared with a previous run to catch regressions:
+#
+#   python -m util.bench_imagearray --output before.json
+#   python -m util.bench_imagearray --baseline before.json --tolerance 0.2
+#
+# Run from the top of the repo so config.toml is found. Exits 1 on regression.
+
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tracemalloc
+import numpy as np
+import falcon.testing
+import shr
+import timing
+import camera
+from shr import ImageArrayResponse
+from backend.synthetic import Scene
+
+SIZE_X = 4056                           # IMX477
+SIZE_Y = 3040
+
+# Name, binning, subframe size (None = whole frame)
+CASES = (
+    ('full', 1, None),
+    ('bin2', 2, None),
+    ('sub1024', 1, 1024),
+    ('sub512', 1, 512),
+)
+
+
+def stages(raw: np.ndarray, geometry: tuple, with_json: bool):
+    """The chain as (name, fn) pairs, each fn taking the previous result"""
+    req = falcon.testing.create_req()
+    chain = [
+        ('convert', lambda _: camera.raw_to_imagearray(raw, *geometry, timing.recorder.frame(''))),
+        ('imagebytes', lambda a: (a, ImageArrayResponse(a, req).binary)),
+        ('shuffled', lambda r: (r[0], ImageArrayResponse(r[0], req).shuffled)),
+    ]
+    if with_json:
+        chain += [
+            ('tolist', lambda r: list(map(tuple, r[0].astype(int).tolist()))),
+            ('json', lambda l: ImageArrayResponse(l, req).json),
+        ]
+    return chain
+
+def time_chain(raw, geometry, with_json, repeat):
+    """Best time per stage, including the spans inside raw_to_imagearray()"""
+    best = {}
+    for _ in range(repeat):
+        recorder = timing.TimingRecorder(enabled=True, log=False)
+        f = recorder.frame('bench')
+        with f.span('convert'):
+            result = camera.raw_to_imagearray(raw, *geometry, f)
+        for name, fn in stages(raw, geometry, with_json)[1:]:
+            with f.span(name):
+                result = fn(result)
+        for name, seconds in f.spans:
+            best[name] = min(best.get(name, seconds), seconds)
+    return best
+
+def memory_chain(raw, geometry, with_json):
+    """Peak and retained bytes per stage"""
+    memory = {}
+    result = None
+    for name, fn in stages(raw, geometry, with_json):
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        result = fn(result)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory[name] = (peak - base, current - base)
+    return memory
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    old = {(r['case'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = old.get((r['case'], r['stage']))
+        if b is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if b[key] and r[key] is not None and r[key] > b[key] * (1 + tolerance):
+                regressions.append(f"{r['case']} {r['stage']} {key} {b[key]:.4g} -> {r[key]:.4g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the imagearray conversion chain')
+    parser.add_argument('--repeat', type=int, default=3, help='Take the best of N runs')
+    parser.add_argument('--json', action='store_true', help='Include JSON encoding (slow at full size)')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with results from an earlier --output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown/growth over baseline')
+    args = parser.parse_args()
+
+    shr.set_shr_logger(logging.getLogger())
+
+    results = []
+    print(f'{"case":<10}{"stage":<12}{"ms":>10}{"MB/s":>10}{"peak MB":>10}{"kept MB":>10}')
+    for case, binning, sub in CASES:
+        width, height = SIZE_X // binning, SIZE_Y // binning
+        raw = Scene('stars', width, height).frame(30.0).view(np.uint8)   # As make_array('raw') gives us
+        if sub is None:
+            geometry = (0, 0, width, height)
+        else:
+            geometry = ((width - sub) // 2, (height - sub) // 2, sub, sub)
+        mb = geometry[2] * geometry[3] * 2 / 1e6
+        times = time_chain(raw, geometry, args.json, args.repeat)
+        memory = memory_chain(raw, geometry, args.json)
+        for stage, seconds in times.items():
+            peak, kept = memory.get(stage, (None, None))
+            results.append({'case': case, 'stage': stage, 'seconds': seconds, 'mb_per_s': mb / seconds if seconds else None,
+                            'peak_bytes': peak, 'retained_bytes': kept})
+            mem = f'{peak / 1e6:>10.1f}{kept / 1e6:>10.1f}' if peak is not None else ''
+            rate = f'{mb / seconds:>10.0f}' if seconds else f'{"-":>10}'
+            print(f'{case:<10}{stage:<12}{seconds * 1000:>10.2f}{rate}{mem}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'machine': platform.machine(), 'time': time.time(), 'results': results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f'REGRESSION: {r}')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+# Helpers for the benchmarks that drive the real Alpaca server over HTTP.
+#
+# serve() runs the app from app.create_app() in-process against the simulated
+# camera, on a free local port, and AlpacaClient is a minimal Alpaca client
+# that times each request to the first and last byte of the response.
+# simulated_app() gives the app itself, for calling as plain WSGI.
+
+import json
+import struct
+import logging
+import itertools
+import http.client
+import threading
+import time
+from urllib.parse import urlencode
+from wsgiref.simple_server import make_server
+from config import Config
+
+class AlpacaError(Exception):
+    pass
+
+def simulated_app(time_scale: float = 1.0, scene: str = None, log_level: str = 'WARNING'):
+    """Point Config at the simulator and build the app from app.create_app()"""
+    Config.camera_backend = 'simulator'
+    Config.simulator_time_scale = time_scale
+    if scene is not None:
+        Config.simulator_scene = scene
+    Config.log_level = logging.getLevelName(log_level)
+    Config.log_to_stdout = False
+    import app                                  # Not before Config is set up
+    return app.create_app()
+
+def serve(time_scale: float = 1.0, scene: str = None, log_level: str = 'WARNING'):
+    """Start the app against the simulator in a background thread. Returns the server."""
+    wsgi_app = simulated_app(time_scale, scene, log_level)
+    import app
+    httpd = make_server('127.0.0.1', 0, wsgi_app, handler_class=app.LoggingWSGIRequestHandler)
+    threading.Thread(target=httpd.serve_forever, name='Server', daemon=True).start()
+    return httpd
+
+class AlpacaClient:
+    def __init__(self, host: str, port: int, client_id: int = 1, device: str = 'camera/0', timeout: float = 120):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.device = device
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+
+    def request(self, method: str, endpoint: str, params: dict = {}, accept: str = None):
+        """Returns (body, seconds to first byte, seconds to last byte)"""
+        params = dict(params, ClientID=self.client_id, ClientTransactionID=next(self._ids))
+        return self.send(method, f'/api/v1/{self.device}/{endpoint}', params, accept)
+
+    def send(self, method: str, path: str, params: dict, accept: str = None):
+        """Request any path with the params exactly as given. Returns as request()"""
+        headers = {}
+        if accept is not None:
+            headers['Accept'] = accept
+        body = None
+        if method == 'GET':
+            path += '?' + urlencode(params)
+        else:
+            body = urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            t0 = time.perf_counter()
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            first = time.perf_counter() - t0
+            data = resp.read()
+            last = time.perf_counter() - t0
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise AlpacaError(f'{method} {path}: HTTP {resp.status} {data[:200]}')
+        return data, first, last
+
+    def _check(self, endpoint: str, data: bytes):
+        reply = json.loads(data)
+        if reply['ErrorNumber'] != 0:
+            raise AlpacaError(f"{endpoint}: {reply['ErrorNumber']} {reply['ErrorMessage']}")
+        return reply.get('Value')
+
+    def get(self, endpoint: str, **params):
+        return self._check(endpoint, self.request('GET', endpoint, params)[0])
+
+    def put(self, endpoint: str, **params):
+        return self._check(endpoint, self.request('PUT', endpoint, params)[0])
+
+    def imagearray(self, accept: str = 'application/imagebytes'):
+        """Returns (payload, seconds to first byte, seconds to last byte)"""
+        data, first, last = self.request('GET', 'imagearray', accept=accept)
+        if accept != 'application/json':
+            error = struct.unpack('<II', data[:8])[1]
+            if error != 0:
+                raise AlpacaError(f'imagearray: {error} {data[44:].decode()}')
+        else:
+            self._check('imagearray', data)
+        return data, first, last
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Concurrent multi-client load generator for the Alpaca API. Models the mix we
+# see at the observatory:
+#
+#   nina      - exposes, polls imageready, downloads the full frame, repeats
+#   phd2      - loops short guide exposures and downloads them
+#   dashboard - polls temperature and camera state
+#
+# There is only one camera, so nina and phd2 clients take turns exposing
+# (startexposure to the end of the download). All of their polling, and all
+# dashboard traffic, hits the server concurrently, which is what loads the
+# serving layer. Each client records the latency of every request; the report
+# gives percentiles per client type and endpoint, timeouts and errors.
+#
+# By default an in-process server on the simulated camera is used. Give
+# --dashboard several counts to see how latency scales with client count:
+#
+#   python -m util.loadtest --nina 1 --phd2 1 --dashboard 1 2 4 8 --seconds 30
+#
+# Run from the top of the repo so config.toml is found.
+
+import sys
+import time
+import json
+import argparse
+import threading
+import numpy as np
+from util.harness import serve, AlpacaClient, AlpacaError
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}                     # (client type, endpoint) -> [secs]
+        self.timeouts = {}
+        self.errors = {}
+
+    def timed(self, kind: str, endpoint: str, fn, *args, **kwargs):
+        key = (kind, endpoint)
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except TimeoutError:
+            with self.lock:
+                self.timeouts[key] = self.timeouts.get(key, 0) + 1
+            return None
+        except (AlpacaError, OSError):
+            with self.lock:
+                self.errors[key] = self.errors.get(key, 0) + 1
+            return None
+        with self.lock:
+            self.latencies.setdefault(key, []).append(time.perf_counter() - t0)
+        return result
+
+    def report(self) -> list:
+        rows = []
+        for key in sorted(set(self.latencies) | set(self.timeouts) | set(self.errors)):
+            values = np.array(self.latencies.get(key, [0.0])) * 1000
+            p50, p90, p99 = np.percentile(values, (50, 90, 99))
+            rows.append({'client': key[0], 'endpoint': key[1], 'count': len(self.latencies.get(key, [])),
+                         'p50_ms': round(p50, 1), 'p90_ms': round(p90, 1), 'p99_ms': round(p99, 1),
+                         'max_ms': round(values.max(), 1),
+                         'timeouts': self.timeouts.get(key, 0), 'errors': self.errors.get(key, 0)})
+        return rows
+
+def expose(client: AlpacaClient, stats: Stats, kind: str, duration: float, poll: float, stop: threading.Event):
+    """One exposure and download. Gives up if startexposure fails or we are stopped"""
+    started = stats.timed(kind, 'startexposure',
+                          lambda: client.put('startexposure', Duration=duration, Light='true') or True)
+    if started is None:
+        return
+    while not stop.is_set():
+        if stats.timed(kind, 'imageready', client.get, 'imageready'):
+            stats.timed(kind, 'imagearray', client.imagearray)
+            return
+        time.sleep(poll)
+
+def nina(client, stats, camera, stop, args):
+    while not stop.is_set():
+        with camera:
+            expose(client, stats, 'nina', args.exposure, args.poll, stop)
+
+def phd2(client, stats, camera, stop, args):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        with camera:
+            expose(client, stats, 'phd2', args.guide_exposure, args.poll, stop)
+        stop.wait(max(args.guide_exposure - (time.perf_counter() - t0), 0))
+
+def dashboard(client, stats, camera, stop, args):
+    while not stop.is_set():
+        for endpoint in ('ccdtemperature', 'camerastate', 'connected'):
+            stats.timed('dashboard', endpoint, client.get, endpoint)
+        stop.wait(args.dashboard_interval)
+
+def run(host: str, port: int, counts: dict, args) -> Stats:
+    stats = Stats()
+    camera = threading.Lock()
+    stop = threading.Event()
+    threads = []
+    client_id = 1
+    for kind, fn in (('nina', nina), ('phd2', phd2), ('dashboard', dashboard)):
+        for _ in range(counts[kind]):
+            client = AlpacaClient(host, port, client_id, timeout=args.timeout)
+            client_id += 1
+            threads.append(threading.Thread(target=fn, args=(client, stats, camera, stop, args), daemon=True))
+    for t in threads:
+        t.start()
+    stop.wait(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join(args.timeout + args.exposure + 5)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-client load test of the Alpaca API')
+    parser.add_argument('--server', help='host:port of a running server. Default is in-process on the simulator')
+    parser.add_argument('--nina', type=int, default=1, help='Number of imaging clients')
+    parser.add_argument('--phd2', type=int, default=1, help='Number of guiding clients')
+    parser.add_argument('--dashboard', type=int, nargs='+', default=[1], help='Number(s) of dashboard clients')
+    parser.add_argument('--seconds', type=float, default=30, help='Length of each run')
+    parser.add_argument('--exposure', type=float, default=5.0, help='Imaging exposure (secs)')
+    parser.add_argument('--guide-exposure', type=float, default=2.0, help='Guide exposure and cadence (secs)')
+    parser.add_argument('--dashboard-interval', type=float, default=1.0, help='Dashboard poll interval (secs)')
+    parser.add_argument('--poll', type=float, default=0.25, help='imageready poll interval (secs)')
+    parser.add_argument('--timeout', type=float, default=10, help='Request timeout (secs)')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='Simulator exposure/readout time multiplier')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        httpd = serve(args.time_scale)
+        host, port = '127.0.0.1', httpd.server_port
+    AlpacaClient(host, port).put('connected', Connected='true')
+
+    results = []
+    for dashboards in args.dashboard:
+        counts = {'nina': args.nina, 'phd2': args.phd2, 'dashboard': dashboards}
+        print(f'\n{counts}')
+        print(f'{"client":<11}{"endpoint":<16}{"count":>7}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"max ms":>9}{"t/o":>5}{"err":>5}')
+        rows = run(host, port, counts, args).report()
+        for r in rows:
+            print(f'{r["client"]:<11}{r["endpoint"]:<16}{r["count"]:>7}{r["p50_ms"]:>9}{r["p90_ms"]:>9}'
+                  f'{r["p99_ms"]:>9}{r["max_ms"]:>9}{r["timeouts"]:>5}{r["errors"]:>5}')
+        results.append({'clients': counts, 'results': rows})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
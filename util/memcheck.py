@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# Memory regression check. Calls the real app as plain WSGI, in this thread,
+# against the simulated camera, and measures with tracemalloc the peak and
+# retained allocations of startexposure, imagearray (ImageBytes and JSON),
+# binning changes and subframe changes. Each is checked against a budget,
+# given as a multiple of the frame size where it scales with the frame. A
+# download's budget is on top of the raw frame read out, which is always the
+# whole sensor, however small the subframe.
+#
+# Then it runs hundreds of exposure/download cycles and checks that memory in
+# use doesn't grow, and that every camera request was released.
+#
+#   python -m util.memcheck [--exposures 300] [--imagebytes-budget 4]
+#
+# The response body is counted and discarded as it is produced, so only the
+# server's own allocations are measured. Simulated frame rendering happens
+# while waiting for imageready, outside the measurements; a real camera
+# allocates the raw frame in make_array, during the download, so the waiting
+# frame is taken off the baseline and counted against the download. The frame
+# the last download kept for analysis is let go first, outside the measurement,
+# so that freeing it can't hide what the download allocates; the download may
+# then keep no more than its subframe. Run from the top of
+# the repo so config.toml is found. Exits 1 if any budget is exceeded.
+
+import gc
+import re
+import sys
+import time
+import struct
+import argparse
+import tracemalloc
+from urllib.parse import urlencode
+import falcon.testing
+from util.harness import simulated_app
+
+SIZE_X = 4056                           # IMX477
+SIZE_Y = 3040
+JSON_SUBFRAME = 256                     # JSON is too slow for whole frames
+MB = 1024 * 1024
+
+class Server:
+    """Calls the app directly. call() returns the body length and raises on any error"""
+    def __init__(self, app):
+        self.app = app
+        self.ids = 0
+
+    def call(self, method: str, endpoint: str, accept: str = None, **params):
+        self.ids += 1
+        params = dict(params, ClientID=1, ClientTransactionID=self.ids)
+        headers = {'Accept': accept} if accept else {}
+        if method == 'GET':
+            environ = falcon.testing.create_environ(f'/api/v1/camera/0/{endpoint}', urlencode(params),
+                                                   method=method, headers=headers)
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            environ = falcon.testing.create_environ(f'/api/v1/camera/0/{endpoint}', method=method,
+                                                   headers=headers, body=urlencode(params))
+        status = []
+        result = self.app(environ, lambda s, h, exc_info=None: status.append(s))
+        length, head, tail = 0, b'', b''
+        for chunk in result:
+            if not head:
+                head = chunk[:8]
+            tail = (tail + chunk[-200:])[-200:]
+            length += len(chunk)
+        if hasattr(result, 'close'):
+            result.close()
+        if not status[0].startswith('200'):
+            raise Exception(f'{method} {endpoint}: {status[0]}')
+        if head[:1] == b'{':
+            match = re.search(rb'"ErrorNumber":(\d+)', tail)
+            error = int(match.group(1)) if match else 0
+        else:
+            error = struct.unpack('<II', head)[1]
+        if error != 0:
+            raise Exception(f'{method} {endpoint}: Alpaca error {error}')
+        return length
+
+    def wait_ready(self):
+        import camera                           # Polling the state directly keeps the measurements clean
+        while not camera.state.imageReady:
+            time.sleep(0.01)
+
+    def waiting_frame(self) -> int:
+        """Bytes of the raw frame the simulator is holding for the next download"""
+        import camera
+        return camera.picam2.wait(camera.state.job).make_array('raw').nbytes
+
+
+def measure(fn, held: int = 0):
+    """Peak and retained bytes allocated by fn(), counting ``held`` bytes
+    already allocated, that fn() frees, as allocated by it"""
+    gc.collect()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0] - held
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - base
+    return peak, retained
+
+def download(server: Server, accept: str):
+    """Peak and retained bytes of an imagearray download, and the raw frame size"""
+    raw = server.waiting_frame()
+    import camera
+    camera.state.last_frame = None
+    peak, retained = measure(lambda: server.call('GET', 'imagearray', accept), raw)
+    return peak, retained, raw
+
+def subframe(server: Server, binning: int, size: int = None):
+    width, height = SIZE_X // binning, SIZE_Y // binning
+    numx, numy = (width, height) if size is None else (size, size)
+    server.call('PUT', 'startx', StartX=(width - numx) // 2)
+    server.call('PUT', 'starty', StartY=(height - numy) // 2)
+    server.call('PUT', 'numx', NumX=numx)
+    server.call('PUT', 'numy', NumY=numy)
+    return numx * numy * 2
+
+def set_binning(server: Server, binning: int):
+    server.call('PUT', 'binx', BinX=binning)
+    server.call('PUT', 'biny', BinY=binning)
+
+def cycle(server: Server, accept: str = 'application/imagebytes'):
+    server.call('PUT', 'startexposure', Duration=0.001, Light='true')
+    server.wait_ready()
+    server.call('GET', 'imagearray', accept)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check memory use against budgets using the simulated camera')
+    parser.add_argument('--exposures', type=int, default=300, help='Exposures for the leak check')
+    parser.add_argument('--imagebytes-budget', type=float, default=4.0, help='ImageBytes peak beyond the raw frame, in frame sizes')
+    parser.add_argument('--json-budget', type=float, default=80.0, help='JSON imagearray peak beyond the raw frame, in frame sizes')
+    parser.add_argument('--change-budget', type=float, default=1.0, help='Peak for binning/subframe changes and startexposure (MB)')
+    parser.add_argument('--retained-budget', type=float, default=0.25, help='Retained after any operation (MB)')
+    parser.add_argument('--leak-budget', type=float, default=1.0, help='Growth over the leak check (MB)')
+    args = parser.parse_args()
+
+    server = Server(simulated_app(1.0))
+    import camera
+    server.call('PUT', 'connected', Connected='true')
+    server.call('PUT', 'gain', Gain=1)
+    # Warm up: every binning and both formats once, so one-off setup isn't counted
+    for binning in (2, 1):
+        set_binning(server, binning)
+        subframe(server, binning)
+        cycle(server)
+    subframe(server, 1, JSON_SUBFRAME)
+    cycle(server, 'application/json')
+
+    tracemalloc.start()
+    failures = []
+
+    def check(name, peak, retained, peak_budget, raw=0, kept=0):
+        # A download may keep its subframe, and nothing more
+        peak_budget += raw
+        ok = peak <= peak_budget and retained <= args.retained_budget * MB + kept
+        print(f'{name:<28}{peak / MB:>10.2f}{peak_budget / MB:>10.2f}{retained / MB:>10.2f}  {"ok" if ok else "FAIL"}')
+        if not ok:
+            failures.append(name)
+
+    print(f'{"operation":<28}{"peak MB":>10}{"budget":>10}{"kept MB":>10}')
+    change = args.change_budget * MB
+    frame = subframe(server, 1)
+    check('startexposure', *measure(lambda: server.call('PUT', 'startexposure', Duration=0.001, Light='true')), change)
+    server.wait_ready()
+    peak, retained, raw = download(server, 'application/imagebytes')
+    check('imagearray imagebytes', peak, retained, args.imagebytes_budget * frame, raw, frame)
+    check('binning 1 -> 2', *measure(lambda: set_binning(server, 2)), change)
+    frame = subframe(server, 2)
+    cycle(server)
+    server.call('PUT', 'startexposure', Duration=0.001, Light='true')
+    server.wait_ready()
+    peak, retained, raw = download(server, 'application/imagebytes')
+    check('imagearray imagebytes bin2', peak, retained, args.imagebytes_budget * frame, raw, frame)
+    check('binning 2 -> 1', *measure(lambda: set_binning(server, 1)), change)
+    frame = JSON_SUBFRAME * JSON_SUBFRAME * 2
+    check('subframe change', *measure(lambda: subframe(server, 1, JSON_SUBFRAME)), change)
+    server.call('PUT', 'startexposure', Duration=0.001, Light='true')
+    server.wait_ready()
+    peak, retained, raw = download(server, 'application/json')
+    check(f'imagearray json {JSON_SUBFRAME}', peak, retained, args.json_budget * frame, raw, frame)
+
+    # Leak check, on whole frames as that's where a leak hurts
+    subframe(server, 1)
+    cycle(server)
+    gc.collect()
+    base = tracemalloc.get_traced_memory()[0]
+    for _ in range(args.exposures):
+        cycle(server)
+        if camera.picam2.unreleased:
+            failures.append('unreleased camera requests')
+            print(f'FAIL: {camera.picam2.unreleased} camera requests not released')
+            break
+    gc.collect()
+    growth = tracemalloc.get_traced_memory()[0] - base
+    ok = growth <= args.leak_budget * MB
+    print(f'{args.exposures} exposures: {growth / MB:.2f} MB growth, budget {args.leak_budget:.2f} MB  {"ok" if ok else "FAIL"}')
+    if not ok:
+        failures.append('leak')
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+            print(f'  {stat}')
+    tracemalloc.stop()
+
+    server.call('PUT', 'connected', Connected='false')
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
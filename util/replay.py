@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# Replay a session recorded with record_traffic = true in config.toml. Each
+# ClientID in the recording (NINA, PHD2, SharpCap...) gets its own thread that
+# re-issues that client's requests, with the original parameters, at the
+# original times divided by --speed. Reports latency per endpoint, and how far
+# behind schedule requests went out, which shows when the server can't keep
+# up with the real polling pattern. Alpaca errors are counted too: a replay
+# that polls imageready less often than the recording did should not fail.
+#
+# By default the replay is against an in-process server on the simulated
+# camera, with exposures sped up by the same factor as the replay:
+#
+#   python -m util.replay logs/traffic.jsonl --speed 10
+#   python -m util.replay logs/traffic.jsonl --server raspberrypi:5555
+#
+# Run from the top of the repo so config.toml is found.
+
+import sys
+import json
+import struct
+import time
+import argparse
+import threading
+import numpy as np
+from util.harness import serve, AlpacaClient, AlpacaError
+
+def load(path: str) -> dict:
+    """Requests from a recording, grouped by ClientID"""
+    clients = {}
+    base = last = 0.0
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'start' in entry:                # Each session appended to the file starts again from 0
+                base = last
+                continue
+            entry['t'] += base
+            last = entry['t']
+            client_id = next((v for k, v in entry['q'].items() if k.lower() == 'clientid'), None)
+            clients.setdefault(client_id, []).append(entry)
+    return clients
+
+def alpaca_error(data: bytes) -> int:
+    """ErrorNumber from a JSON or ImageBytes reply"""
+    if data[:1] == b'{':
+        return json.loads(data).get('ErrorNumber', 0)
+    return struct.unpack('<II', data[:8])[1] if len(data) >= 44 else 0
+
+def replay(client: AlpacaClient, requests: list, speed: float, t0: float, results: list):
+    for r in requests:
+        due = t0 + (r['t'] / speed if speed else 0)
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        late = time.perf_counter() - due
+        endpoint = r['p'].rsplit('/', 1)[-1]
+        try:
+            data, _, seconds = client.send(r['m'], r['p'], r['q'], r.get('a'))
+            error = alpaca_error(data) != 0
+        except (AlpacaError, OSError):
+            seconds, error = 0.0, True
+        results.append((endpoint, seconds, late, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded Alpaca session')
+    parser.add_argument('recording', help='File written with record_traffic = true')
+    parser.add_argument('--server', help='host:port of a running server. Default is in-process on the simulator')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay this many times faster. 0 for no waiting')
+    parser.add_argument('--time-scale', type=float, help='Simulator exposure/readout time multiplier. Default 1/speed')
+    parser.add_argument('--timeout', type=float, default=120, help='Request timeout (secs)')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    clients = load(args.recording)
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        time_scale = args.time_scale if args.time_scale is not None else (1 / args.speed if args.speed else 0)
+        httpd = serve(time_scale)
+        host, port = '127.0.0.1', httpd.server_port
+
+    results = []
+    t0 = time.perf_counter() + 0.1
+    threads = [threading.Thread(target=replay, args=(AlpacaClient(host, port, timeout=args.timeout),
+                                                    requests, args.speed, t0, results), daemon=True)
+               for requests in clients.values()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    print(f'{len(results)} requests from {len(clients)} clients in {elapsed:.1f}s')
+    print(f'{"endpoint":<22}{"count":>7}{"p50 ms":>9}{"p99 ms":>9}{"max ms":>9}{"late ms":>9}{"err":>5}')
+    rows = []
+    for endpoint in sorted({r[0] for r in results}):
+        mine = [r for r in results if r[0] == endpoint]
+        ok = np.array([r[1] for r in mine if not r[3]] or [0.0]) * 1000
+        late = np.array([r[2] for r in mine]) * 1000
+        row = {'endpoint': endpoint, 'count': len(mine),
+               'p50_ms': round(np.percentile(ok, 50), 1), 'p99_ms': round(np.percentile(ok, 99), 1),
+               'max_ms': round(ok.max(), 1), 'late_p99_ms': round(np.percentile(late, 99), 1),
+               'errors': sum(r[3] for r in mine)}
+        rows.append(row)
+        print(f'{endpoint:<22}{row["count"]:>7}{row["p50_ms"]:>9}{row["p99_ms"]:>9}{row["max_ms"]:>9}'
+              f'{row["late_p99_ms"]:>9}{row["errors"]:>5}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'recording': args.recording, 'speed': args.speed, 'results': rows}, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())